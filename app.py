@@ -1,31 +1,45 @@
-
 import streamlit as st
-import google.generativeai as genai
-import pandas as pd
-import json
-import time
 from datetime import datetime
 import os
-import io
-
-# File Processing
-from pypdf import PdfReader
-from docx import Document
+import copy
+import hashlib
+import re
+import bisect
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
-# Google Services
-try:
-    import gspread
-    from oauth2client.service_account import ServiceAccountCredentials
-    from googleapiclient.discovery import build
-    from googleapiclient.http import MediaIoBaseUpload
-    from google.oauth2 import service_account
-    GOOGLE_SERVICES_AVAILABLE = True
-except ImportError:
-    GOOGLE_SERVICES_AVAILABLE = False
+# Core Logic (Text Extraction, Drive, Gemini) – compartida con qa_batch.py
+from qa_core import (
+    OUTBOX_FLUSH_INTERVAL,
+    OUTBOX_MAX_ATTEMPTS,
+    PROMPT_F2,
+    SpoolFullError,
+    VIDEO_JOB_POLL_INTERVAL,
+    analyze_script,
+    configure_gemini,
+    extract_text,
+    get_gemini_rate_limiter,
+    get_outbox,
+    get_review_store,
+    get_video_job_engine,
+    get_video_spool,
+    google_configured,
+    queue_folder,
+    queue_project_files,
+    queue_report,
+    queue_review_mirror,
+    test_drive_connection,
+    write_bytes_atomic,
+)
 
 # --- CONFIGURACIÓN E INICIALIZACIÓN ---
 st.set_page_config(page_title="Heineken QA Compliance", page_icon="🍺", layout="wide")
 
+# El flusher del outbox arranca con el proceso (una vez; los reruns reutilizan la instancia):
+# los trabajos que quedaron pendientes antes de un reinicio se sincronizan sin esperar a
+# que alguien envíe una revisión nueva
+get_outbox()
+
 # --- HEINEKEN THEME CSS ---
 st.markdown("""
 <style>
@@ -261,6 +275,12 @@ if 'risk_index' not in st.session_state:
     st.session_state.risk_index = 0
 if 'recommendation_index' not in st.session_state:
     st.session_state.recommendation_index = 0
+if 'video_job_id' not in st.session_state:
+    st.session_state.video_job_id = None
+if 'batch_results' not in st.session_state:
+    st.session_state.batch_results = []
+if 'outbox_jobs' not in st.session_state:
+    st.session_state.outbox_jobs = []
 
 # --- HELPER FUNCTIONS ---
 def next_step():
@@ -275,784 +295,19 @@ def reset_app():
     st.session_state.analysis_result = None
     st.session_state.risk_index = 0
     st.session_state.recommendation_index = 0
+    st.session_state.video_job_id = None
+    st.session_state.batch_results = []
+    st.session_state.outbox_jobs = []
 
-# --- CORE LOGIC (Text Extraction, Drive, Gemini) ---
-# ... (Reusing robust functions from previous iteration) ...
-
-# GOOGLE DRIVE & DOCS
-SCOPE = [
-    'https://spreadsheets.google.com/feeds', 
-    'https://www.googleapis.com/auth/drive',
-    'https://www.googleapis.com/auth/documents'
-]
-def get_drive_service():
-    """Obtiene el servicio de Google Drive con domain-wide delegation si está configurado"""
-    if not GOOGLE_SERVICES_AVAILABLE:
-        print("❌ Google Services no están disponibles (librerías no instaladas)")
-        return None
-    if not os.path.exists("credentials.json"):
-        print("❌ Archivo credentials.json no encontrado")
-        return None
-    try:
-        creds = service_account.Credentials.from_service_account_file("credentials.json", scopes=SCOPE)
-        
-        # Intentar usar domain-wide delegation si está configurado
-        # Esto permite que la cuenta de servicio actúe en nombre de un usuario real
-        # que sí tiene cuota de almacenamiento
-        user_email = st.secrets.get("GOOGLE_DRIVE_USER_EMAIL", None)
-        if user_email:
-            print(f"🔐 Usando domain-wide delegation para: {user_email}")
-            creds = creds.with_subject(user_email)
-        
-        service = build('drive', 'v3', credentials=creds)
-        print("✅ Servicio de Drive inicializado correctamente")
-        return service
-    except Exception as e:
-        print(f"❌ Error al inicializar servicio de Drive: {e}")
-    return None
-
-def test_drive_connection():
-    """Función de prueba para verificar la conexión con Google Drive"""
-    results = {
-        "service_available": False,
-        "credentials_file_exists": False,
-        "api_enabled": False,
-        "folder_accessible": False,
-        "error_messages": []
-    }
-    
-    # Verificar si las librerías están disponibles
-    if not GOOGLE_SERVICES_AVAILABLE:
-        results["error_messages"].append("❌ Google libraries are not installed")
-        return results
-    
-    # Verificar si existe el archivo de credenciales
-    if os.path.exists("credentials.json"):
-        results["credentials_file_exists"] = True
-        print("✅ Archivo credentials.json encontrado")
-    else:
-        results["error_messages"].append("❌ credentials.json file not found in current directory")
-        return results
-    
-    # Intentar obtener el servicio
-    try:
-        service = get_drive_service()
-        if service:
-            results["service_available"] = True
-            print("✅ Servicio de Drive creado exitosamente")
-        else:
-            results["error_messages"].append("❌ Could not create Drive service")
-            return results
-    except Exception as e:
-        results["error_messages"].append(f"❌ Error creating service: {str(e)}")
-        return results
-    
-    # Verificar si la API está habilitada intentando hacer una operación simple
-    try:
-        # Intentar listar archivos (operación básica)
-        about = service.about().get(fields='user,storageQuota').execute()
-        results["api_enabled"] = True
-        print(f"✅ API de Drive habilitada. Usuario: {about.get('user', {}).get('emailAddress', 'N/A')}")
-    except Exception as e:
-        error_str = str(e)
-        if "403" in error_str or "accessNotConfigured" in error_str or "API has not been used" in error_str:
-            results["error_messages"].append("❌ Google Drive API is not enabled. Go to: https://console.cloud.google.com/apis/library/drive.googleapis.com")
-        else:
-            results["error_messages"].append(f"❌ Error verifying API: {error_str}")
-        return results
-    
-    # Verificar acceso a la carpeta raíz o Shared Drive
-    try:
-        root_id = st.secrets.get("GOOGLE_DRIVE_FOLDER_ID")
-        if not root_id:
-            results["error_messages"].append("❌ GOOGLE_DRIVE_FOLDER_ID is not set in secrets")
-            return results
-        
-        # Detectar si es Shared Drive (los IDs de Shared Drives empiezan con 0A)
-        is_shared_drive = root_id.startswith('0A') and len(root_id) > 10
-        
-        if is_shared_drive:
-            # Para Shared Drives, usar drives().get()
-            try:
-                drive = service.drives().get(
-                    driveId=root_id,
-                    fields='id,name'
-                ).execute()
-                results["folder_accessible"] = True
-                print(f"✅ Shared Drive accesible: {drive.get('name', 'N/A')} (ID: {root_id})")
-            except Exception as drive_error:
-                error_str = str(drive_error)
-                if "404" in error_str:
-                    results["error_messages"].append(f"❌ Shared Drive with ID '{root_id}' does not exist or the service account is not a member")
-                elif "403" in error_str:
-                    results["error_messages"].append("❌ No permission. Ensure the service account is a member of the Shared Drive (check your service account email in Google Cloud Console).")
-                else:
-                    results["error_messages"].append(f"❌ Error accessing Shared Drive: {error_str}")
-        else:
-            # Para carpetas normales
-            folder = service.files().get(
-                fileId=root_id,
-                fields='id,name,permissions',
-                supportsAllDrives=True
-            ).execute()
-            results["folder_accessible"] = True
-            print(f"✅ Carpeta accesible: {folder.get('name', 'N/A')} (ID: {root_id})")
-    except Exception as e:
-        error_str = str(e)
-        if "404" in error_str:
-            results["error_messages"].append(f"❌ Folder/Shared Drive with ID '{root_id}' does not exist or you do not have access")
-        elif "403" in error_str:
-            results["error_messages"].append(f"❌ No permission. Ensure the service account has access")
-        else:
-            results["error_messages"].append(f"❌ Error accessing: {error_str}")
-    
-    return results
-
-def find_or_create_folder(drive_service, folder_name, parent_id):
-    """Busca o crea una carpeta, soportando Shared Drives"""
-    # Detectar si es un Shared Drive (los IDs de Shared Drives empiezan con 0A)
-    is_shared_drive = parent_id.startswith('0A') and len(parent_id) > 10
-    
-    query = f"mimeType='application/vnd.google-apps.folder' and name='{folder_name}' and '{parent_id}' in parents and trashed=false"
-    
-    # Parámetros necesarios para Shared Drives
-    list_params = {
-        'q': query,
-        'fields': 'files(id)',
-        'supportsAllDrives': True,
-        'includeItemsFromAllDrives': True
-    }
-    
-    results = drive_service.files().list(**list_params).execute()
-    files = results.get('files', [])
-    
-    if files:
-        return files[0]['id']
-    else:
-        # Crear nueva carpeta
-        file_metadata = {
-            'name': folder_name,
-            'mimeType': 'application/vnd.google-apps.folder',
-            'parents': [parent_id]
-        }
-        
-        # Parámetros para crear en Shared Drive
-        create_params = {
-            'body': file_metadata,
-            'fields': 'id',
-            'supportsAllDrives': True
-        }
-        
-        folder = drive_service.files().create(**create_params).execute()
-        return folder.get('id')
-
-def upload_file_to_drive(drive_service, file_obj, filename, folder_id, mime_type=None):
-    """Sube un archivo a Drive, soportando Shared Drives"""
-    media = MediaIoBaseUpload(file_obj, mimetype=mime_type, resumable=True)
-    file_metadata = {'name': filename, 'parents': [folder_id]}
-    
-    # Parámetros necesarios para Shared Drives
-    create_params = {
-        'body': file_metadata,
-        'media_body': media,
-        'fields': 'id, webViewLink',
-        'supportsAllDrives': True
-    }
-    
-    file = drive_service.files().create(**create_params).execute()
-    return file
-
-def create_google_doc(drive_service, title, content, folder_id, im_name):
-    """Crea un Google Doc en Drive con el contenido especificado"""
-    try:
-        from googleapiclient.discovery import build
-        from google.oauth2 import service_account
-        
-        # Obtener credenciales para Docs API
-        if os.path.exists("credentials.json"):
-            creds = service_account.Credentials.from_service_account_file("credentials.json", scopes=SCOPE)
-            user_email = st.secrets.get("GOOGLE_DRIVE_USER_EMAIL", None)
-            if user_email:
-                creds = creds.with_subject(user_email)
-            
-            docs_service = build('docs', 'v1', credentials=creds)
-            
-            # Crear el documento vacío
-            doc = docs_service.documents().create(body={'title': title}).execute()
-            document_id = doc.get('documentId')
-            
-            # Preparar el contenido del documento con formato
-            formatted_content = content
-            
-            # Insertar contenido en el documento
-            requests = [
-                {
-                    'insertText': {
-                        'location': {'index': 1},
-                        'text': formatted_content
-                    }
-                }
-            ]
-            docs_service.documents().batchUpdate(
-                documentId=document_id,
-                body={'requests': requests}
-            ).execute()
-            
-            # Mover el documento a la carpeta correcta
-            file = drive_service.files().get(fileId=document_id, fields='parents', supportsAllDrives=True).execute()
-            previous_parents = ",".join(file.get('parents', []))
-            
-            drive_service.files().update(
-                fileId=document_id,
-                addParents=folder_id,
-                removeParents=previous_parents,
-                fields='id, webViewLink',
-                supportsAllDrives=True
-            ).execute()
-            
-            # Obtener el link del documento
-            file_info = drive_service.files().get(
-                fileId=document_id,
-                fields='id, webViewLink',
-                supportsAllDrives=True
-            ).execute()
-            
-            return file_info
-        else:
-            return None
-    except Exception as e:
-        print(f"❌ Error al crear Google Doc: {e}")
-        import traceback
-        traceback.print_exc()
-        return None
-
-def save_project_files_to_drive(brand, campaign, influencer, version, files):
-    """Guarda archivos en Drive con jerarquía: Campaña -> Influencer -> Versión"""
-    if not GOOGLE_SERVICES_AVAILABLE: 
-        st.error("❌ Google Services are not available")
-        return []
-    
-    uploaded_links = []
-    try:
-        print("🔍 Iniciando guardado en Drive...")
-        service = get_drive_service()
-        root_id = st.secrets.get("GOOGLE_DRIVE_FOLDER_ID")
-        
-        if not service:
-            st.error("⚠️ Could not create Google Drive service. Check credentials.json")
-            return []
-        
-        if not root_id:
-            st.error("⚠️ GOOGLE_DRIVE_FOLDER_ID is not set in secrets.toml")
-            return []
-        
-        print(f"📁 Carpeta raíz ID: {root_id}")
-        
-        # Jerarquía: Campaña -> Influencer -> Versión (sin Brand)
-        print(f"📂 Creando estructura: {campaign} -> {influencer} -> {version}")
-        camp_id = find_or_create_folder(service, campaign, root_id)
-        print(f"✅ Carpeta de campaña creada/encontrada: {camp_id}")
-        
-        inf_id = find_or_create_folder(service, influencer, camp_id)
-        print(f"✅ Carpeta de influencer creada/encontrada: {inf_id}")
-        
-        ver_id = find_or_create_folder(service, version, inf_id)
-        print(f"✅ Carpeta de versión creada/encontrada: {ver_id}")
-        
-        # Subir archivos a la carpeta de versión
-        print(f"📤 Subiendo {len(files)} archivo(s)...")
-        for i, (name, data, mime) in enumerate(files, 1):
-            try:
-                # Asegurar que el objeto de archivo esté en el inicio
-                if hasattr(data, 'seek'):
-                    data.seek(0)
-                print(f"  📄 Subiendo archivo {i}/{len(files)}: {name}")
-                f = upload_file_to_drive(service, data, name, ver_id, mime)
-                link = f.get('webViewLink', '')
-                if link:
-                    uploaded_links.append(link)
-                    print(f"  ✅ Archivo subido: {link}")
-                else:
-                    print(f"  ⚠️ Archivo subido pero sin link")
-            except Exception as file_error:
-                print(f"  ❌ Error al subir {name}: {file_error}")
-                st.warning(f"⚠️ Could not upload file {name}: {str(file_error)}")
-        
-        # Retornar también el link de la carpeta de versión para fácil acceso
-        folder_link = f"https://drive.google.com/drive/folders/{ver_id}"
-        uploaded_links.insert(0, folder_link)  # Agregar al inicio como link principal
-        print(f"✅ Proceso completado. {len(uploaded_links)} link(s) generado(s)")
-            
-    except Exception as e: 
-        error_msg = str(e)
-        print(f"Drive Upload Error: {e}")
-        
-        # Mensaje de error más amigable y específico
-        if "403" in error_msg or "accessNotConfigured" in error_msg or "API has not been used" in error_msg:
-            st.error("""
-            **❌ Error: Google Drive API is not enabled**
-            
-            To fix this:
-            
-            1. Go to: https://console.cloud.google.com/apis/library/drive.googleapis.com
-            2. Select your project (or create it if it doesn't exist)
-            3. Click "ENABLE"
-            4. Wait a few minutes and try again
-            
-            **Note:** Ensure the service account has permissions to access Drive.
-            """)
-        elif "401" in error_msg or "credentials" in error_msg.lower():
-            st.error("""
-            **❌ Google Drive authentication error**
-            
-            Verify that:
-            - The `credentials.json` file exists and is valid
-            - The service account has permissions in Drive
-            - The service account permissions include access to the root folder
-            """)
-        else:
-            st.error(f"""
-            **❌ Error uploading files to Drive**
-            
-            Details: {error_msg}
-            
-            Check your connection and Google Drive credentials.
-            """)
-        
-    return uploaded_links
-
-# TEXT EXTRACTION
-def reconstruct_paragraphs(text):
-    """Merges fragmented lines into paragraphs (handles bad PDF/DOCX conversions)."""
-    lines = text.split('\n')
-    cleaned_lines = []
-    buffer = ""
-    
-    for line in lines:
-        line = line.strip()
-        
-        if not line:
-            # Only flush if the buffer seems to be a complete sentence/header
-            if buffer and buffer.endswith(('.', '!', '?', ':')):
-                cleaned_lines.append(buffer)
-                buffer = ""
-            # Otherwise, assume it's an intra-paragraph break (double spacing) and keep buffer
-            continue
-            
-        # If we have a buffer, check if we should merge
-        if buffer:
-             buffer += " " + line
-        else:
-            buffer = line
-            
-    if buffer: cleaned_lines.append(buffer)
-    return "\n".join(cleaned_lines)
-
-def extract_text(uploaded_file):
-    try:
-        text = ""
-        if uploaded_file.name.endswith('.pdf'):
-            reader = PdfReader(uploaded_file)
-            text = "\n".join([p.extract_text() for p in reader.pages])
-        elif uploaded_file.name.endswith('.docx'):
-            doc = Document(uploaded_file)
-            text = "\n".join([p.text for p in doc.paragraphs])
-        else: # txt
-            text = uploaded_file.getvalue().decode("utf-8")
-            
-        return reconstruct_paragraphs(text), None
-    except Exception as e: return None, str(e)
-
-# GEMINI
-# GEMINI
-def analyze_content(prompt, content):
-    api_key = st.secrets.get("GEMINI_API_KEY")
-    genai.configure(api_key=api_key)
-    model = genai.GenerativeModel('gemini-2.5-flash')
-    
-    # Set temperature to 0.0 for deterministic, consistent results
-    config = genai.types.GenerationConfig(temperature=0.0)
-    
-    return model.generate_content([prompt, content], generation_config=config)
-
-def clean_json_response(text):
-    """Robust cleaning for LLM JSON responses."""
-    try:
-        # Strip markdown code blocks
-        clean = text.replace("```json", "").replace("```", "").strip()
-        
-        # Find JSON boundaries
-        start = clean.find("{")
-        end = clean.rfind("}")
-        if start != -1 and end != -1:
-            clean = clean[start:end+1]
-            
-        # Fix common control character issues
-        # Replace actual newlines inside strings with \n is hard without regex, 
-        # but often strict=False helps. 
-        # For "Invalid control character", we usually need to remove strictly invalid chars 
-        # or just hope json.loads(strict=False) works.
-        # Let's try raw parsing first, then fallback cleaning.
-        return json.loads(clean, strict=False)
-    except json.JSONDecodeError:
-        # Fallback: Try to escape unescaped control characters
-        # This is a naive fix but covers many "newline in string" cases
-        import re
-        try:
-            # Remove control characters that aren't common whitespace
-            # clean = re.sub(r'[\x00-\x1f\x7f-\x9f]', '', clean) # Too aggressive, removes \n
-            return json.loads(clean, strict=False)
-        except:
-             raise # Re-raise original error if simple strict=False didn't fix it
-
-# DATABASE
-def initialize_sheet_headers(sheet):
-    """Inicializa los encabezados de la hoja si no existen"""
-    try:
-        # Verificar si la primera fila está vacía o no tiene encabezados
-        first_row = sheet.row_values(1)
-        expected_headers = ["Timestamp", "Brand", "Campaign", "Influencer", "Version", "Score", "Recommendations", "Drive Folder Link", "Original File Link", "Report Link"]
-        
-        if not first_row or first_row != expected_headers:
-            if first_row and first_row[0] not in ["Timestamp", "TS"]:
-                sheet.clear()
-            
-            # Agregar encabezados
-            sheet.append_row(expected_headers)
-            
-            # Intentar formatear encabezados usando la API de Sheets directamente
-            try:
-                spreadsheet = sheet.spreadsheet
-                # Obtener el ID de la hoja (gspread expone sheet.id)
-                sheet_id = sheet.id
-                
-                requests = [
-                    {
-                        "updateDimensionProperties": {
-                            "range": {
-                                "sheetId": sheet_id,
-                                "dimension": "COLUMNS",
-                                "startIndex": 0,
-                                "endIndex": 1
-                            },
-                            "properties": {"pixelSize": 150},
-                            "fields": "pixelSize"
-                        }
-                    },
-                    {
-                        "updateDimensionProperties": {
-                            "range": {
-                                "sheetId": sheet_id,
-                                "dimension": "COLUMNS",
-                                "startIndex": 1,
-                                "endIndex": 2
-                            },
-                            "properties": {"pixelSize": 100},
-                            "fields": "pixelSize"
-                        }
-                    },
-                    {
-                        "updateDimensionProperties": {
-                            "range": {
-                                "sheetId": sheet_id,
-                                "dimension": "COLUMNS",
-                                "startIndex": 2,
-                                "endIndex": 3
-                            },
-                            "properties": {"pixelSize": 200},
-                            "fields": "pixelSize"
-                        }
-                    },
-                    {
-                        "updateDimensionProperties": {
-                            "range": {
-                                "sheetId": sheet_id,
-                                "dimension": "COLUMNS",
-                                "startIndex": 3,
-                                "endIndex": 4
-                            },
-                            "properties": {"pixelSize": 150},
-                            "fields": "pixelSize"
-                        }
-                    },
-                    {
-                        "updateDimensionProperties": {
-                            "range": {
-                                "sheetId": sheet_id,
-                                "dimension": "COLUMNS",
-                                "startIndex": 4,
-                                "endIndex": 5
-                            },
-                            "properties": {"pixelSize": 150},
-                            "fields": "pixelSize"
-                        }
-                    },
-                    {
-                        "updateDimensionProperties": {
-                            "range": {
-                                "sheetId": sheet_id,
-                                "dimension": "COLUMNS",
-                                "startIndex": 5,
-                                "endIndex": 6
-                            },
-                            "properties": {"pixelSize": 80},
-                            "fields": "pixelSize"
-                        }
-                    },
-                    {
-                        "updateDimensionProperties": {
-                            "range": {
-                                "sheetId": sheet_id,
-                                "dimension": "COLUMNS",
-                                "startIndex": 6,
-                                "endIndex": 7
-                            },
-                            "properties": {"pixelSize": 300},
-                            "fields": "pixelSize"
-                        }
-                    },
-                    {
-                        "updateDimensionProperties": {
-                            "range": {
-                                "sheetId": sheet_id,
-                                "dimension": "COLUMNS",
-                                "startIndex": 7,
-                                "endIndex": 10
-                            },
-                            "properties": {"pixelSize": 200},
-                            "fields": "pixelSize"
-                        }
-                    },
-                    {
-                        "repeatCell": {
-                            "range": {
-                                "sheetId": sheet_id,
-                                "startRowIndex": 0,
-                                "endRowIndex": 1,
-                                "startColumnIndex": 0,
-                                "endColumnIndex": len(expected_headers)
-                            },
-                            "cell": {
-                                "userEnteredFormat": {
-                                    "backgroundColor": {"red": 0.0, "green": 0.24, "blue": 0.18},
-                                    "textFormat": {
-                                        "foregroundColor": {"red": 1.0, "green": 1.0, "blue": 1.0},
-                                        "bold": True,
-                                        "fontSize": 11
-                                    },
-                                    "horizontalAlignment": "CENTER"
-                                }
-                            },
-                            "fields": "userEnteredFormat(backgroundColor,textFormat,horizontalAlignment)"
-                        }
-                    }
-                ]
-                
-                spreadsheet.batch_update({"requests": requests})
-            except Exception as format_error:
-                # Si falla el formato avanzado, al menos los encabezados estarán ahí
-                print(f"Nota: No se pudo aplicar formato avanzado a los encabezados: {format_error}")
-            
-    except Exception as e:
-        print(f"Error inicializando encabezados: {e}")
-
-def save_db_record(record, drive_links):
-    """Guarda registro en Sheets con encabezados y links formateados"""
-    sheet_id = st.secrets.get("GOOGLE_SHEET_ID")
-    if GOOGLE_SERVICES_AVAILABLE and sheet_id and os.path.exists("credentials.json"):
-        try:
-            creds = service_account.Credentials.from_service_account_file("credentials.json", scopes=SCOPE)
-            client = gspread.authorize(creds)
-            sheet = client.open_by_key(sheet_id).sheet1
-            
-            # Inicializar encabezados si es necesario
-            initialize_sheet_headers(sheet)
-            
-            # Preparar datos de la fila - asegurar que todos sean strings válidos
-            def clean_value(value):
-                """Limpia un valor para que sea válido en Sheets"""
-                if value is None:
-                    return ""
-                if isinstance(value, (int, float)):
-                    return value
-                # Convertir a string y limpiar caracteres problemáticos
-                value_str = str(value)
-                # Reemplazar saltos de línea con espacios para evitar problemas
-                value_str = value_str.replace('\n', ' ').replace('\r', ' ')
-                # Limitar longitud para evitar problemas (Sheets tiene límite de 50,000 caracteres por celda)
-                if len(value_str) > 50000:
-                    value_str = value_str[:50000] + "... [truncated]"
-                return value_str
-            
-            timestamp = clean_value(record.get("TS", datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
-            brand = clean_value(record.get("Brand", ""))
-            campaign = clean_value(record.get("Camp", ""))
-            influencer = clean_value(record.get("Inf", ""))
-            version = clean_value(record.get("Ver", ""))
-            score = record.get("Score", 0)
-            # Asegurar que score sea un número
-            try:
-                score = float(score) if score else 0
-            except (ValueError, TypeError):
-                score = 0
-            recs = clean_value(record.get("Recs", ""))
-            
-            # Extraer links de Drive (el primero es la carpeta, luego archivos)
-            folder_link = clean_value(drive_links[0] if len(drive_links) > 0 else "")
-            file_link = clean_value(drive_links[1] if len(drive_links) > 1 else "")
-            report_link = clean_value(drive_links[2] if len(drive_links) > 2 else "")
-            
-            # Agregar fila con datos - todos los valores deben ser válidos
-            row_data = [
-                timestamp,
-                brand,
-                campaign,
-                influencer,
-                version,
-                score,  # Número
-                recs,
-                folder_link,
-                file_link,
-                report_link
-            ]
-            
-            # Verificar que no haya None en los datos
-            row_data = ["" if v is None else v for v in row_data]
-            
-            next_row = sheet.row_count + 1
-            sheet.append_row(row_data)
-            
-            # Formatear links como hipervínculos usando fórmulas HYPERLINK
-            # Escapar comillas dobles en los links para evitar errores
-            def escape_link(link):
-                """Escapa comillas en links para fórmulas HYPERLINK"""
-                if not link:
-                    return ""
-                return link.replace('"', '""')  # Escapar comillas dobles
-            
-            try:
-                if folder_link and folder_link.strip():
-                    safe_link = escape_link(folder_link)
-                    sheet.update(f'H{next_row}', f'=HYPERLINK("{safe_link}", "📁 Open Folder")', value_input_option='USER_ENTERED')
-            except Exception as e:
-                print(f"⚠️ No se pudo formatear link de carpeta: {e}")
-            
-            try:
-                if file_link and file_link.strip():
-                    safe_link = escape_link(file_link)
-                    sheet.update(f'I{next_row}', f'=HYPERLINK("{safe_link}", "📄 View File")', value_input_option='USER_ENTERED')
-            except Exception as e:
-                print(f"⚠️ No se pudo formatear link de archivo: {e}")
-            
-            try:
-                if report_link and report_link.strip():
-                    safe_link = escape_link(report_link)
-                    sheet.update(f'J{next_row}', f'=HYPERLINK("{safe_link}", "📊 View Report")', value_input_option='USER_ENTERED')
-            except Exception as e:
-                print(f"⚠️ No se pudo formatear link de reporte: {e}")
-            
-            # Formatear la celda de Score con color según el valor
-            try:
-                score_col = 6  # Columna F (Score)
-                score_color = {"red": 0.3, "green": 0.7, "blue": 0.3}  # Verde por defecto
-                if score < 60:
-                    score_color = {"red": 0.95, "green": 0.3, "blue": 0.3}  # Rojo
-                elif score < 90:
-                    score_color = {"red": 1.0, "green": 0.8, "blue": 0.4}  # Amarillo/Naranja
-                
-                spreadsheet = sheet.spreadsheet
-                sheet_id = sheet.id
-                
-                requests = [
-                    {
-                        "repeatCell": {
-                            "range": {
-                                "sheetId": sheet_id,
-                                "startRowIndex": next_row - 1,
-                                "endRowIndex": next_row,
-                                "startColumnIndex": score_col - 1,
-                                "endColumnIndex": score_col
-                            },
-                            "cell": {
-                                "userEnteredFormat": {
-                                    "backgroundColor": score_color,
-                                    "textFormat": {"bold": True},
-                                    "horizontalAlignment": "CENTER"
-                                }
-                            },
-                            "fields": "userEnteredFormat(backgroundColor,textFormat,horizontalAlignment)"
-                        }
-                    }
-                ]
-                
-                spreadsheet.batch_update({"requests": requests})
-            except Exception as format_error:
-                # Si falla el formato, no es crítico, los datos ya están guardados
-                print(f"Nota: No se pudo aplicar formato de color al score: {format_error}")
-            
-            return True
-            
-        except Exception as e:
-            st.error(f"❌ Error saving to Sheets: {str(e)}")
-            print(f"Sheets Save Error: {e}")
-            return False
-    return False
-
-
-# PROMPTS (English – AI will respond in English)
-PROMPT_F1 = """
-Act as an expert in advertising regulations (COFEPRIS) and alcohol for Heineken Mexico.
-Your task is to analyse the script looking ONLY for explicit breaches of the law or advertising regulations.
-
-CRITICAL RULES:
-1. Do NOT make assumptions or subjective inferences. Only point out what is EXPLICITLY written or described.
-2. Example: "Coffee shop" is just a café; do NOT assume drug references unless explicit.
-3. If there are no clear risks, state "No risks".
-4. Be brief, direct and corporate.
-5. Do NOT include invalid control characters in the JSON (tabs, literal newlines inside strings). Use \\n for line breaks.
-6. The email must end with "Best regards," followed by the name (the name will be added automatically; do NOT include it in email_draft).
-
-Return ONLY a valid JSON with this exact structure:
-{
-  "score": number (0-100),
-  "risks": [
-    {
-      "risk": "Short name of the risk",
-      "quote": "EXACT verbatim quote from the script where it occurs",
-      "explanation": "Legal explanation based on facts, not assumptions"
-    }
-  ],
-  "recommendations": [
-    "Concrete action 1",
-    "Concrete action 2"
-  ],
-  "email_draft": "Subject: Script Review - [Campaign]\\n\\nDear team,\\n\\nPlease find attached the findings...\\n\\nBest regards,"
-}
-"""
-
-PROMPT_F2 = """
-Act as Heineken Compliance Officer. Audit the video frame by frame under alcohol regulations (COFEPRIS).
-RULES:
-1. Only report visual or audio elements that appear in the video.
-2. Do NOT infer intentions.
-3. Focus on: actual alcohol consumption, minors, driving, excess.
+def back_to_batch():
+    """Vuelve al resumen del lote (Paso 1) descartando la revisión abierta"""
+    st.session_state.step = 1
+    st.session_state.project_data = {}
+    st.session_state.analysis_result = None
+    st.session_state.risk_index = 0
+    st.session_state.recommendation_index = 0
+    st.session_state.outbox_jobs = []
 
-Return ONLY a valid JSON:
-{
-  "score": number (0-100),
-  "risks": [
-    {
-      "risk": "Visual Risk",
-      "timestamp": "MM:SS",
-      "explanation": "Observable fact that breaches the regulation"
-    }
-  ],
-  "recommendations": [
-    "Required edit 1"
-  ],
-  "email_draft": "Formal email body"
-}
-"""
 
 # --- UI LAYOUT ---
 
@@ -1083,6 +338,349 @@ with col_title:
 st.markdown("</div></div>", unsafe_allow_html=True)
 
 
+# --- SCRIPT VIEWER ---
+SPEAKER_PATTERN = re.compile(r'^([A-ZÁÉÍÓÚÑ\s\(\)]{2,30})(:|-)')
+HIGHLIGHT_OPEN = '<span style="background-color: #ffdce0; border-bottom: 2px solid #ff2a2a;">'
+HIGHLIGHT_CLOSE = '</span>'
+
+def _match_char(char):
+    """Normaliza un carácter para comparar citas: minúsculas y saltos de línea como espacio"""
+    if char == "\n":
+        return " "
+    lower = char.lower()
+    # Algunos caracteres cambian de longitud al pasar a minúsculas (p.ej. "İ"); se dejan igual
+    return lower if len(lower) == 1 else char
+
+class QuoteMatcher:
+    """Autómata Aho-Corasick sobre todas las citas: una sola pasada por el texto encuentra
+    todas las apariciones de todas las citas, incluidas las que se traslapan."""
+
+    def __init__(self, quotes):
+        self._goto = [{}]
+        self._fail = [0]
+        self._output = [[]]
+        for index, quote in enumerate(quotes):
+            if not quote:
+                continue
+            node = 0
+            for char in quote:
+                char = _match_char(char)
+                next_node = self._goto[node].get(char)
+                if next_node is None:
+                    next_node = len(self._goto)
+                    self._goto[node][char] = next_node
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._output.append([])
+                node = next_node
+            self._output[node].append((index, len(quote)))
+
+        # Enlaces de falla por BFS; cada nodo hereda las salidas de su sufijo más largo
+        queue = deque(self._goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for char, child in self._goto[node].items():
+                queue.append(child)
+                fallback = self._fail[node]
+                while fallback and char not in self._goto[fallback]:
+                    fallback = self._fail[fallback]
+                self._fail[child] = self._goto[fallback].get(char, 0)
+                self._output[child] = self._output[child] + self._output[self._fail[child]]
+
+    def find(self, text):
+        """Lista de (inicio, fin, índice de cita) con offsets en el texto original"""
+        matches = []
+        node = 0
+        for position, char in enumerate(text):
+            char = _match_char(char)
+            while node and char not in self._goto[node]:
+                node = self._fail[node]
+            node = self._goto[node].get(char, 0)
+            for index, length in self._output[node]:
+                matches.append((position - length + 1, position + 1, index))
+        matches.sort()
+        return matches
+
+def merge_intervals(matches):
+    """Une las apariciones traslapadas o contiguas en intervalos (inicio, fin) ordenados"""
+    intervals = []
+    for start, end, _ in matches:
+        if intervals and start <= intervals[-1][1]:
+            intervals[-1][1] = max(intervals[-1][1], end)
+        else:
+            intervals.append([start, end])
+    return intervals
+
+def highlight_segment(segment, offset, intervals, interval_ends):
+    """Envuelve en <span> las partes de `segment` (que empieza en `offset`) dentro de los intervalos"""
+    if not intervals:
+        return segment
+    parts = []
+    cursor = 0
+    i = bisect.bisect_right(interval_ends, offset)
+    while i < len(intervals) and intervals[i][0] < offset + len(segment):
+        start = max(intervals[i][0] - offset, 0)
+        end = min(intervals[i][1] - offset, len(segment))
+        parts.append(segment[cursor:start])
+        parts.append(HIGHLIGHT_OPEN + segment[start:end] + HIGHLIGHT_CLOSE)
+        cursor = end
+        i += 1
+    parts.append(segment[cursor:])
+    return "".join(parts)
+
+def format_script_line(line, offset=0, intervals=(), interval_ends=()):
+    """HTML de una línea del guion; `offset` es la posición de la línea en el texto completo"""
+    stripped = line.strip()
+    if not stripped: return "<br>" # Single break for empty lines
+    offset += len(line) - len(line.lstrip())
+    line = stripped
+    
+    # Check for Speaker (e.g., "LUISITO:", "Narrador - ", "LUISITO (en off):")
+    # Heuristic: Uppercase words at start followed by colon or dash
+    # Relaxed regex: Allow parens inside speaker name, match start of line
+    match = SPEAKER_PATTERN.match(line)
+    if match:
+        speaker = match.group(1)
+        rest = line[len(speaker):]
+        speaker = highlight_segment(speaker, offset, intervals, interval_ends)
+        rest = highlight_segment(rest, offset + len(match.group(1)), intervals, interval_ends)
+        # Bold the speaker
+        return f'<div style="margin-top: 10px; margin-bottom: 4px;"><strong>{speaker}</strong>{rest}</div>'
+    
+    text = highlight_segment(line, offset, intervals, interval_ends)
+    
+    # Check for Scene Headers or Camera Directions (often Uppercase)
+    # If line is short and mostly uppercase
+    if len(line) < 50 and line.isupper():
+         return f'<div style="margin-top: 15px; margin-bottom: 5px; font-weight: bold; color: #555; text-decoration: underline;">{text}</div>'
+
+    # Check for Questions (Interview style)
+    if line.endswith("?"):
+         return f'<div style="margin-bottom: 8px; font-weight: bold; color: #008200;">{text}</div>'
+    
+    # Normal text
+    return f'<div style="margin-bottom: 8px; margin-left: 10px;">{text}</div>'
+
+def file_content_hash(uploaded_file):
+    """sha256 del contenido del archivo subido (llave de las cachés del visor)"""
+    return hashlib.sha256(uploaded_file.getbuffer()).hexdigest()
+
+# Los parámetros con "_" no forman parte de la llave de st.cache_data: la llave es el hash
+@st.cache_data(show_spinner=False, max_entries=32)
+def get_script_text(content_hash, _uploaded_file):
+    # Las excepciones no se guardan en st.cache_data: una falla pasajera se reintenta en el
+    # siguiente rerun en lugar de dejar el visor vacío
+    txt, err = extract_text(_uploaded_file)
+    if err:
+        raise RuntimeError(err)
+    return txt or ""
+
+@st.cache_data(show_spinner=False, max_entries=64)
+def find_quote_offsets(content_hash, quotes, _uploaded_file):
+    """Apariciones de las citas en el texto: [(inicio, fin, índice de riesgo)], en una pasada"""
+    return QuoteMatcher(quotes).find(get_script_text(content_hash, _uploaded_file))
+
+# Páginas del visor: solo se arma y se envía al navegador la página visible
+SCRIPT_PAGE_LINES = 80
+SCRIPT_PAGE_CHARS = 8000
+
+@st.cache_data(show_spinner=False, max_entries=32)
+def get_script_pages(content_hash, _uploaded_file):
+    """Divide el guion en páginas: lista de (offset inicial, líneas) por página"""
+    txt = get_script_text(content_hash, _uploaded_file)
+    pages = []
+    page_lines, page_start, page_chars = [], 0, 0
+    offset = 0
+    for line in txt.split('\n'):
+        if page_lines and (len(page_lines) >= SCRIPT_PAGE_LINES or page_chars + len(line) > SCRIPT_PAGE_CHARS):
+            pages.append((page_start, page_lines))
+            page_lines, page_start, page_chars = [], offset, 0
+        page_lines.append(line)
+        page_chars += len(line) + 1
+        offset += len(line) + 1
+    pages.append((page_start, page_lines))
+    return pages
+
+@st.cache_data(show_spinner=False, max_entries=256)
+def render_script_page(content_hash, quotes, page, _uploaded_file):
+    """HTML de una página del guion con las citas de los riesgos resaltadas.
+
+    El resaltado se calcula sobre el texto plano y se aplica al armar cada línea, así que
+    nunca cae dentro de etiquetas HTML ni de otro resaltado.
+    """
+    page_start, lines = get_script_pages(content_hash, _uploaded_file)[page]
+    intervals = merge_intervals(find_quote_offsets(content_hash, quotes, _uploaded_file))
+    interval_ends = [end for _, end in intervals]
+    parts = []
+    offset = page_start
+    for line in lines:
+        parts.append(format_script_line(line, offset, intervals, interval_ends))
+        offset += len(line) + 1
+    return "".join(parts)
+
+def find_risk_page(content_hash, quotes, risk_index, _uploaded_file):
+    """Página que contiene la primera aparición de la cita del riesgo (None si no aparece)"""
+    for start, _, index in find_quote_offsets(content_hash, quotes, _uploaded_file):
+        if index == risk_index:
+            page_starts = [page_start for page_start, _ in get_script_pages(content_hash, _uploaded_file)]
+            return bisect.bisect_right(page_starts, start) - 1
+    return None
+
+def render_live_risk(risk):
+    """Vista compacta de un riesgo recibido por streaming, antes de tener el resultado completo"""
+    detail = risk.get('quote') or risk.get('timestamp') or ''
+    detail = f' — <em>"{detail}"</em>' if detail else ''
+    st.markdown(
+        f"<div style='border-left: 4px solid #ff2a2a; background: #fff8f8; padding: 6px 12px; margin-bottom: 6px; border-radius: 4px;'>🚨 <strong>{risk.get('risk', 'Risk')}</strong>{detail}</div>",
+        unsafe_allow_html=True
+    )
+
+@st.fragment(run_every=VIDEO_JOB_POLL_INTERVAL)
+def render_video_job_progress():
+    """Muestra el avance del job de video en curso sin bloquear el script"""
+    job = get_video_job_engine().get(st.session_state.video_job_id)
+    if job is None:
+        st.session_state.video_job_id = None
+        st.warning("The video analysis job is no longer available. Please start it again.")
+        return
+
+    if job["state"] == "done":
+        st.session_state.analysis_result = job["result"]
+        st.session_state.video_job_id = None
+        next_step()
+        st.rerun()
+    elif job["state"] == "failed":
+        st.error(job["error"])
+        if job["raw_response"]:
+            st.code(job["raw_response"], language='json')
+        if st.button("Dismiss", key="dismiss_video_job"):
+            st.session_state.video_job_id = None
+            st.rerun()
+    else:
+        st.progress(job["progress"], text=f"🎬 {job['message']} (job {job['id'][:8]})")
+        for risk in job["partial_risks"]:
+            render_live_risk(risk)
+
+
+BATCH_DEFAULT_CONCURRENCY = 4
+BATCH_MAX_CONCURRENCY = 8
+
+def run_batch_analysis(files, brand, campaign, version, im_name, windowed, concurrency):
+    """Analiza varios guiones en paralelo (máximo `concurrency` a la vez) con barra de avance"""
+    batch = [
+        {
+            "project_data": {
+                "brand": brand,
+                "campaign": campaign,
+                "influencer": os.path.splitext(f.name)[0],
+                "version": version,
+                "im_name": im_name,
+                "type": "script",
+                "file": f
+            },
+            "result": None,
+            "error": None,
+            "raw_response": None
+        }
+        for f in files
+    ]
+    progress = st.progress(0.0, text=f"Analyzing 0/{len(batch)} scripts...")
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="batch-analysis") as executor:
+        futures = {executor.submit(analyze_script, item["project_data"]["file"], windowed): item for item in batch}
+        for done, future in enumerate(as_completed(futures), 1):
+            item = futures[future]
+            try:
+                item["result"], item["error"], item["raw_response"] = future.result()
+            except Exception as e:
+                item["error"] = str(e)
+            progress.progress(done / len(batch), text=f"Analyzing {done}/{len(batch)} scripts...")
+    return batch
+
+def render_batch_summary():
+    """Tabla de scores del lote; cada fila abre la revisión normal del Paso 2"""
+    st.markdown("---")
+    st.markdown("#### 📊 Batch Results")
+    st.dataframe(
+        [
+            {
+                "File": item["project_data"]["file"].name,
+                "Influencer": item["project_data"]["influencer"],
+                "Score": item["result"].get("score", 0) if item["result"] else None,
+                "Risks": len(item["result"].get("risks", [])) if item["result"] else None,
+                "Status": "✅ Analyzed" if item["result"] else f"❌ {item['error']}"
+            }
+            for item in st.session_state.batch_results
+        ],
+        hide_index=True
+    )
+    for i, item in enumerate(st.session_state.batch_results):
+        if item["result"] is None:
+            continue
+        if st.button(f"Review {item['project_data']['file'].name} ▶️", key=f"batch_review_{i}"):
+            st.session_state.project_data = dict(item["project_data"])
+            # Copia para que las ediciones del Paso 2 no alteren el resultado del lote
+            st.session_state.analysis_result = copy.deepcopy(item["result"])
+            st.session_state.risk_index = 0
+            st.session_state.recommendation_index = 0
+            st.session_state.outbox_jobs = []
+            next_step()
+            st.rerun()
+
+
+DRIVE_QUOTA_HELP = (
+    "**Cannot upload files to Drive**\n\n"
+    "Service accounts do not have storage quota. To fix this:\n\n"
+    "**Option 1 (Recommended):** Ask your Google Workspace admin to:\n"
+    "1. Enable \"Domain-wide delegation\" for the service account\n"
+    "2. Configure the required scopes in Google Workspace Admin Console\n\n"
+    "**Option 2:** Files are saved locally. You can upload them to Drive manually later.\n\n"
+    "The record will be saved to Sheets with all analysis information."
+)
+
+def outbox_job_statuses():
+    """Estado de cada trabajo encolado en el Paso 3: [(etiqueta, estado)]"""
+    jobs = st.session_state.outbox_jobs
+    statuses = get_outbox().status([job_id for _, job_id in jobs])
+    default = {"state": "queued", "attempts": 0, "last_error": None, "result": None, "progress": None}
+    return [(label, statuses.get(job_id, default)) for label, job_id in jobs]
+
+def outbox_jobs_finished(job_statuses):
+    return all(job["state"] in ("synced", "failed") for _, job in job_statuses)
+
+def draw_outbox_status(job_statuses):
+    """queued / retry / uploading / synced / failed por trabajo"""
+    for label, job in job_statuses:
+        if job["state"] == "synced":
+            links = " ".join(f"[Open]({link})" for link in (job["result"] or {}).get("links", []) if link)
+            st.markdown(f"✅ **{label}:** synced {links}")
+        elif job["state"] == "failed":
+            st.error(f"❌ {label}: failed after {job['attempts']} attempts – {job['last_error']}")
+            if "storageQuotaExceeded" in job["last_error"] or "Service Accounts do not have storage quota" in job["last_error"]:
+                st.warning(DRIVE_QUOTA_HELP)
+        elif job["state"] == "running" and job["progress"] is not None:
+            st.progress(job["progress"], text=f"⬆️ {label}: uploading {job['progress']:.0%}")
+        elif job["attempts"]:
+            st.markdown(f"⏳ **{label}:** queued – retry {job['attempts']}/{OUTBOX_MAX_ATTEMPTS} ({job['last_error']})")
+        else:
+            st.markdown(f"⏳ **{label}:** queued")
+
+@st.fragment(run_every=OUTBOX_FLUSH_INTERVAL)
+def poll_outbox_status():
+    job_statuses = outbox_job_statuses()
+    draw_outbox_status(job_statuses)
+    if outbox_jobs_finished(job_statuses):
+        # Todo terminó: un rerun completo deja el estado final sin sondeo
+        st.rerun()
+
+def render_outbox_status():
+    """Estado de lo encolado en el Paso 3, leído del outbox local; solo se sondea cada
+    OUTBOX_FLUSH_INTERVAL mientras quede algo pendiente"""
+    job_statuses = outbox_job_statuses()
+    if outbox_jobs_finished(job_statuses):
+        draw_outbox_status(job_statuses)
+    else:
+        poll_outbox_status()
+
 # --- STEP 1: CONFIGURATION ---
 if st.session_state.step == 1:
     st.markdown('<div class="step-card">', unsafe_allow_html=True)
@@ -1233,15 +831,67 @@ if st.session_state.step == 1:
                     - Folder accessible: {folder_status}
                     """)
     
+    with st.expander("📈 Gemini Quota Status", expanded=False):
+        quota = get_gemini_rate_limiter().stats()
+        col_q1, col_q2, col_q3, col_q4 = st.columns(4)
+        col_q1.metric("Queued calls", quota["queue_depth"])
+        col_q2.metric("Throttled time", f"{quota['throttled_seconds']} s")
+        col_q3.metric("Requests / retries", f"{quota['requests']} / {quota['retries']}")
+        col_q4.metric("Budget left", f"{quota['available_requests']} req")
+        st.caption(f"Limits: {quota['rpm_limit']} requests/min · {quota['tpm_limit']:,} tokens/min · {quota['available_tokens']:,} tokens available now")
+    
+    with st.expander("📚 Review History", expanded=False):
+        only_version = st.checkbox("Only this version", value=False, key="history_only_version")
+        # Consulta local e indexada (no lee Sheets): filtra por lo que ya esté en el formulario
+        reviews = get_review_store().query(
+            brand=brand, campaign=campaign.strip(), influencer=influencer.strip(),
+            version=version if only_version else None, limit=100
+        )
+        if reviews:
+            st.dataframe(
+                [
+                    {
+                        "Date": r["ts"],
+                        "Campaign": r["campaign"],
+                        "Influencer": r["influencer"],
+                        "Version": r["version"],
+                        "Score": r["score"],
+                        "Risks": len(r["risks_json"]),
+                        "Reviewer": r["reviewer"],
+                    }
+                    for r in reviews
+                ],
+                hide_index=True
+            )
+        else:
+            st.caption("No saved reviews match the brand, campaign and influencer above.")
+    
     st.markdown("---")
     
     uploaded_file = None
+    windowed_mode = False
+    batch_mode = False
     if "Phase 1" in fase:
-        uploaded_file = st.file_uploader("Upload Script (PDF, DOCX, TXT)", type=['pdf', 'docx', 'txt'])
+        batch_mode = st.checkbox("📚 Batch mode (multiple scripts)", value=False, help="Review many scripts under the same brand, campaign and version. Each file name is used as the influencer name.")
+        if batch_mode:
+            batch_files = st.file_uploader("Upload Scripts (PDF, DOCX, TXT)", type=['pdf', 'docx', 'txt'], accept_multiple_files=True)
+            batch_concurrency = st.number_input("Max concurrent analyses", min_value=1, max_value=BATCH_MAX_CONCURRENCY, value=BATCH_DEFAULT_CONCURRENCY)
+        else:
+            uploaded_file = st.file_uploader("Upload Script (PDF, DOCX, TXT)", type=['pdf', 'docx', 'txt'])
+        windowed_mode = st.checkbox("⚡ Parallel analysis for long scripts", value=False, help="Splits long scripts into overlapping sections that are analyzed at the same time and merged")
     else:
         uploaded_file = st.file_uploader("Upload Video (MP4, MOV)", type=['mp4', 'mov'])
         
-    if st.button("Start Analysis ▶️"):
+    if batch_mode:
+        if st.button("Start Batch Analysis ▶️"):
+            if campaign and batch_files:
+                st.session_state.batch_results = run_batch_analysis(
+                    batch_files, brand, campaign, version, im_name, windowed_mode, int(batch_concurrency)
+                )
+                st.rerun()
+            else:
+                st.warning("Please enter the campaign name and upload at least one script")
+    elif st.button("Start Analysis ▶️"):
         if campaign and influencer and uploaded_file:
             st.session_state.project_data = {
                 "brand": brand,
@@ -1255,50 +905,50 @@ if st.session_state.step == 1:
             # Run Analysis immediately to transition
             with st.spinner("Processing with Gemini AI..."):
                 if "Phase 1" in fase:
-                    txt, err = extract_text(uploaded_file)
-                    if txt:
-                        # Clean text for better matching
-                        txt = txt.replace("\r", "")
-                        resp = analyze_content(PROMPT_F1, txt)
-                        print(f"DEBUG: Raw AI Response (Text): {resp.text}")
-                        try:
-                            st.session_state.analysis_result = clean_json_response(resp.text)
-                            next_step()
-                            st.rerun()
-                        except Exception as e:
-                            print(f"DEBUG: Parsing Error: {e}")
-                            st.error(f"Error interpreting AI response: {e}")
-                            st.code(resp.text, language='json')
+                    live_risks = st.empty()
+                    shown_risks = []
+
+                    def show_live_risk(risk):
+                        shown_risks.append(risk)
+                        with live_risks.container():
+                            for shown in shown_risks:
+                                render_live_risk(shown)
+
+                    def clear_live_risks():
+                        # Gemini reintentó la llamada: los riesgos parciales ya no aplican
+                        shown_risks.clear()
+                        live_risks.empty()
+
+                    result, error, raw_response = analyze_script(
+                        uploaded_file, windowed_mode, on_risk=show_live_risk, on_restart=clear_live_risks
+                    )
+                    if result is not None:
+                        st.session_state.analysis_result = result
+                        next_step()
+                        st.rerun()
+                    st.error(error)
+                    if raw_response:
+                        st.code(raw_response, language='json')
                 else:
                     # Video Logic – configure Gemini API key before upload (upload_file needs it)
-                    api_key = st.secrets.get("GEMINI_API_KEY")
-                    if not api_key:
+                    if not configure_gemini():
                         st.error("GEMINI_API_KEY is not set in Secrets. Add it in Streamlit Cloud → Settings → Secrets.")
                         st.stop()
-                    genai.configure(api_key=api_key)
-                    with open("temp_vid.mp4", "wb") as f: f.write(uploaded_file.getbuffer())
-                    st.info("Uploading video to Gemini...")
-                    vid_upload = genai.upload_file("temp_vid.mp4")
-                    # Poll for processing completion
-                    with st.spinner(f"Processing video... (Initial state: {vid_upload.state.name})"):
-                        while vid_upload.state.name == "PROCESSING":
-                            time.sleep(5)
-                            vid_upload = genai.get_file(vid_upload.name)
-                    if vid_upload.state.name == "FAILED":
-                        st.error("Video processing failed on Gemini.")
-                        st.stop()
-                    resp = analyze_content(PROMPT_F2, vid_upload)
-                    print(f"DEBUG: Raw AI Response (Video): {resp.text}")
+                    # Cada job tiene su propio archivo en el spool; el worker lo borra al subirlo
                     try:
-                        st.session_state.analysis_result = clean_json_response(resp.text)
-                        next_step()
-                        st.rerun()
-                    except Exception as e:
-                        print(f"DEBUG: Parsing Error: {e}")
-                        st.error(f"Error interpreting AI response: {e}")
-                        st.code(resp.text, language='json')
+                        video_path, content_hash = get_video_spool().write(uploaded_file)
+                    except SpoolFullError as e:
+                        st.error(str(e))
+                        st.stop()
+                    st.session_state.video_job_id = get_video_job_engine().submit(video_path, content_hash, PROMPT_F2)
+                    st.rerun()
         else:
             st.warning("Please complete all fields")
+
+    if st.session_state.video_job_id:
+        render_video_job_progress()
+    if st.session_state.batch_results:
+        render_batch_summary()
     st.markdown('</div>', unsafe_allow_html=True)
 
 
@@ -1317,72 +967,48 @@ elif st.session_state.step == 2:
     with col_left:
         st.markdown("#### 📄 Original Material")
         if p_data['type'] == 'script':
-             txt, _ = extract_text(p_data['file'])
-             
-             
-             # Highlight Logic
-             # We will re-process the text to make it look like a script
-             import re
+             # Texto y HTML memorizados por hash del archivo: los reruns del carrusel no re-parsean
+             if 'content_hash' not in p_data:
+                 p_data['content_hash'] = file_content_hash(p_data['file'])
+             quotes = tuple(r.get('quote', '').strip() for r in risks)
+             try:
+                 total_pages = len(get_script_pages(p_data['content_hash'], p_data['file']))
+             except RuntimeError as e:
+                 total_pages = 0
+                 st.warning(f"⚠️ Could not load the script text: {e}. It will be retried on the next interaction.")
              
-             def format_script_line(line):
-                line = line.strip()
-                if not line: return "<br>" # Single break for empty lines
-                
-                # Check for Speaker (e.g., "LUISITO:", "Narrador - ", "LUISITO (en off):")
-                # Heuristic: Uppercase words at start followed by colon or dash
-                # Relaxed regex: Allow parens inside speaker name, match start of line
-                match = re.match(r'^([A-ZÁÉÍÓÚÑ\s\(\)]{2,30})(:|-)', line)
-                if match:
-                    speaker = match.group(1)
-                    rest = line[len(speaker):]
-                    # Bold the speaker
-                    return f'<div style="margin-top: 10px; margin-bottom: 4px;"><strong>{speaker}</strong>{rest}</div>'
-                
-                # Check for Scene Headers or Camera Directions (often Uppercase)
-                # If line is short and mostly uppercase
-                if len(line) < 50 and line.isupper():
-                     return f'<div style="margin-top: 15px; margin-bottom: 5px; font-weight: bold; color: #555; text-decoration: underline;">{line}</div>'
-
-                # Check for Questions (Interview style)
-                if line.endswith("?"):
-                     return f'<div style="margin-bottom: 8px; font-weight: bold; color: #008200;">{line}</div>'
-                
-                # Normal text
-                return f'<div style="margin-bottom: 8px; margin-left: 10px;">{line}</div>'
-                
-
-
-             formatted_html = ""
-             lines = txt.split('\n')
-             for line in lines:
-                 formatted_html += format_script_line(line)
+             if total_pages:
+                 # Al cambiar de riesgo en el carrusel, saltar a la página de su cita
+                 if risks and p_data.get('script_page_risk') != st.session_state.risk_index % len(risks):
+                     p_data['script_page_risk'] = st.session_state.risk_index % len(risks)
+                     risk_page = find_risk_page(p_data['content_hash'], quotes, p_data['script_page_risk'], p_data['file'])
+                     if risk_page is not None:
+                         p_data['script_page'] = risk_page
+                 page = min(p_data.get('script_page', 0), total_pages - 1)
              
-             # Apply Highlights on top of the formatted HTML?
-             # It's risky to replace inside HTML tags. 
-             # Safe approach: Replace exact text content.
-             # Given the structure, simple string replace might break div tags if regex matches them.
-             # We will try a careful replace or just highlight the raw text logic differently.
-             # Let's try matching the text content.
+                 if total_pages > 1:
+                     col_page_prev, col_page_info, col_page_next = st.columns([1, 4, 1])
+                     with col_page_prev:
+                         if st.button("⬅️", key="prev_page", disabled=page == 0):
+                             p_data['script_page'] = page - 1
+                             st.rerun()
+                     with col_page_next:
+                         if st.button("➡️", key="next_page", disabled=page == total_pages - 1):
+                             p_data['script_page'] = page + 1
+                             st.rerun()
+                     with col_page_info:
+                         st.markdown(f"<div style='text-align: center; color: #555;'>Page {page + 1} of {total_pages}</div>", unsafe_allow_html=True)
              
-             for i, r in enumerate(risks):
-                 quote = r.get('quote', '').strip()
-                 if quote:
-                     # We need to escape special regex chars to avoid errors
-                     safe_quote = re.escape(quote)
-                     # highlighting style
-                     span = f'<span style="background-color: #ffdce0; border-bottom: 2px solid #ff2a2a;">{quote}</span>'
-                     # Replace only non-tag text? Difficult with simple regex. 
-                     # Let's trust that quotes are usually unique enough or don't match HTML tags.
-                     formatted_html = re.sub(safe_quote, span, formatted_html, flags=re.IGNORECASE)
+                 formatted_html = render_script_page(p_data['content_hash'], quotes, page, p_data['file'])
              
-             st.markdown(
-                 f"""
-                 <div style="height: 600px; overflow-y: scroll; padding: 30px; background: #fafafa; border: 1px solid #ddd; border-radius: 8px; font-family: 'Verdana', sans-serif; font-size: 14px; line-height: 1.6; color: #333;">
-                    {formatted_html}
-                 </div>
-                 """, 
-                 unsafe_allow_html=True
-             )
+                 st.markdown(
+                     f"""
+                     <div style="height: 600px; overflow-y: scroll; padding: 30px; background: #fafafa; border: 1px solid #ddd; border-radius: 8px; font-family: 'Verdana', sans-serif; font-size: 14px; line-height: 1.6; color: #333;">
+                        {formatted_html}
+                     </div>
+                     """, 
+                     unsafe_allow_html=True
+                 )
         else:
              st.video(p_data['file'])
              
@@ -1390,6 +1016,8 @@ elif st.session_state.step == 2:
         score = data.get('score', 0)
         score_color = "red" if score < 60 else "orange" if score < 90 else "green"
         st.markdown(f"#### 🛡️ Compliance Score: <span style='color:{score_color}; font-size: 1.2em;'>{score}/100</span>", unsafe_allow_html=True)
+        if data.get('truncated'):
+            st.warning("⚠️ The AI response was cut off. The findings below were recovered from it, but some may be missing.")
         
         st.markdown("---")
         
@@ -1546,99 +1174,89 @@ elif st.session_state.step == 3:
             unsafe_allow_html=True
         )
     
-    if st.button("Confirm and Save All 💾"):
-        # Guardar archivos localmente como respaldo
-        local_files_path = []
-        
-        # Save to Drive
-        files = []
+    if st.button("Confirm and Save All 💾", disabled=bool(st.session_state.outbox_jobs)):
         p_data = st.session_state.project_data
-        p_data['file'].seek(0)
-        file_content = p_data['file'].read()
-        files.append((p_data['file'].name, io.BytesIO(file_content), p_data['file'].type))
+        local_file_path = None
         
-        # Guardar archivo original localmente
-        try:
-            os.makedirs("archivos_guardados", exist_ok=True)
-            local_file_path = f"archivos_guardados/{p_data['campaign']}_{p_data['influencer']}_{p_data['version']}_{p_data['file'].name}"
-            with open(local_file_path, 'wb') as f:
-                f.write(file_content)
-            local_files_path.append(local_file_path)
-        except Exception as e:
-            print(f"⚠️ No se pudo guardar archivo localmente: {e}")
-        
-        im_name = p_data.get('im_name', 'QA Team')
+        # Envío como grafo de tareas en el outbox: primero la carpeta de la versión; luego el
+        # archivo y el reporte en paralelo; la fila de Sheets espera solo a esos links y a la carpeta
+        folder_job = queue_folder(p_data['campaign'], p_data['influencer'], p_data['version'])
+        folder_jobs = [folder_job] if folder_job else []
         
-        doc_content = (
-            f"REVIEW REPORT - {p_data['campaign']}\n\n"
-            f"PROJECT INFORMATION\n"
-            f"{'='*80}\n"
-            f"Brand: {p_data['brand']}\n"
-            f"Campaign: {p_data['campaign']}\n"
-            f"Influencer: {p_data['influencer']}\n"
-            f"Version: {p_data['version']}\n"
-            f"Score: {data.get('score', 0)}/100\n"
-            f"Reviewed by: {im_name}\n"
-            f"Date: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n\n"
-            f"RECOMMENDATIONS\n"
-            f"{'='*80}\n"
-            f"{st.session_state.analysis_result['final_recs']}\n\n"
-            f"FINAL EMAIL\n"
-            f"{'='*80}\n"
-            f"{email_body}\n\n"
-            f"Best regards,\n{im_name}\n"
-        )
+        # Una sola fuente sin copias: memoryview sobre el buffer del archivo subido. Se escribe
+        # una vez al respaldo local y Drive sube después desde ese archivo, por partes
+        with p_data['file'].getbuffer() as file_view:
+            # Guardar archivo original localmente
+            try:
+                os.makedirs("archivos_guardados", exist_ok=True)
+                local_file_path = f"archivos_guardados/{p_data['campaign']}_{p_data['influencer']}_{p_data['version']}_{p_data['file'].name}"
+                # Reemplazo atómico: un reenvío con el mismo nombre no altera los bytes que
+                # un trabajo anterior del outbox todavía tiene enlazados
+                write_bytes_atomic(local_file_path, file_view)
+            except Exception as e:
+                print(f"⚠️ No se pudo guardar archivo localmente: {e}")
+                local_file_path = None
+            
+            # Drive (archivo original + Google Doc) y Sheets se escriben en segundo plano desde el
+            # outbox local: el envío no espera a Google y nada se pierde si la API falla.
+            # El outbox enlaza el respaldo a su spool; sin respaldo local, escribe su propia
+            # copia desde el mismo memoryview
+            file_jobs = queue_project_files(
+                p_data['campaign'], p_data['influencer'], p_data['version'],
+                [(p_data['file'].name, local_file_path or file_view, p_data['file'].type)],
+                depends_on=folder_jobs
+            )
         
-        # Crear Google Doc en lugar de JSON
-        service = get_drive_service()
-        report_link = ""
-        if service:
-            # Obtener la carpeta de versión
-            root_id = st.secrets.get('GOOGLE_DRIVE_FOLDER_ID')
-            if root_id:
-                camp_id = find_or_create_folder(service, p_data['campaign'], root_id)
-                inf_id = find_or_create_folder(service, p_data['influencer'], camp_id)
-                ver_id = find_or_create_folder(service, p_data['version'], inf_id)
-                
-                # Crear el Google Doc
-                doc_title = f"Reporte_{p_data['version']}_{p_data['campaign']}"
-                doc_file = create_google_doc(service, doc_title, doc_content, ver_id, im_name)
-                if doc_file:
-                    report_link = doc_file.get('webViewLink', '')
-                    if report_link:
-                        links.append(report_link)
-                        print(f"✅ Google Doc creado: {report_link}")
+        im_name = p_data.get('im_name', 'QA Team')
+        final_recs = st.session_state.analysis_result.get('final_recs', '')
         
-        # Guardar archivo original y Google Doc en Drive con jerarquía Campaña-Influencer-Versión
-        links = []
-        drive_success = False
-        try:
-            with st.spinner("💾 Saving files to Google Drive..."):
-                links = save_project_files_to_drive(p_data['brand'], p_data['campaign'], p_data['influencer'], p_data['version'], files)
-            
-            if links and len(links) > 0:
-                st.success(f"✅ Files saved to Drive. {len(links)} file(s) uploaded.")
-                drive_success = True
-            else:
-                st.warning("⚠️ Files could not be uploaded to Drive, but the record will be saved to Sheets.")
-        except Exception as drive_error:
-            error_str = str(drive_error)
-            if "storageQuotaExceeded" in error_str or "Service Accounts do not have storage quota" in error_str:
-                warning_msg = (
-                    "**Cannot upload files to Drive**\n\n"
-                    "Service accounts do not have storage quota. To fix this:\n\n"
-                    "**Option 1 (Recommended):** Ask your Google Workspace admin to:\n"
-                    "1. Enable \"Domain-wide delegation\" for the service account\n"
-                    "2. Configure the required scopes in Google Workspace Admin Console\n\n"
-                    "**Option 2:** Files will be saved locally. You can upload them to Drive manually later.\n\n"
-                    "The record will be saved to Sheets with all analysis information."
-                )
-                st.warning(warning_msg)
-            else:
-                st.warning(f"⚠️ Error saving to Drive: {str(drive_error)}. Continuing with saving to Sheets...")
-            links = []
+        # El reporte se arma localmente (.docx) y se sube convertido a Google Doc en una llamada
+        report = {
+            "brand": p_data['brand'],
+            "campaign": p_data['campaign'],
+            "influencer": p_data['influencer'],
+            "version": p_data['version'],
+            "score": data.get('score', 0),
+            "reviewer": im_name,
+            "date": datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+            "content_type": p_data['type'],
+            "risks": data.get('risks', []),
+            "recommendations": final_recs,
+            "email": email_body,
+        }
+        doc_title = f"Reporte_{p_data['version']}_{p_data['campaign']}"
+        report_job = queue_report(doc_title, report, depends_on=folder_jobs)
         
-        # Agregar el link del Google Doc a la lista de links si se creó
-        if report_link:
-            links.append(report_link)
+        record = {
+            "TS": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            "Brand": p_data['brand'],
+            "Camp": p_data['campaign'],
+            "Inf": p_data['influencer'],
+            "Ver": p_data['version'],
+            "Score": data.get('score', 0),
+            "Recs": final_recs,
+        }
+        # La revisión completa queda en la base local; Sheets es un espejo asíncrono
+        review_id = get_review_store().add(
+            record, data.get('risks', []), data.get('recommendations', []),
+            content_type=p_data['type'], file_name=p_data['file'].name, reviewer=im_name
+        )
+        drive_jobs = file_jobs + ([report_job] if report_job else [])
+        mirror_job = queue_review_mirror(review_id, depends_on=drive_jobs, folder_job=folder_job)
         
+        outbox_jobs = [("📁 Drive folder", job_id) for job_id in folder_jobs]
+        outbox_jobs += [(f"📄 {p_data['file'].name}", job_id) for job_id in file_jobs]
+        if report_job:
+            outbox_jobs.append(("📊 Report", report_job))
+        if mirror_job:
+            outbox_jobs.append(("🗂️ Sheets record" if google_configured("GOOGLE_SHEET_ID") else "🔗 Drive links", mirror_job))
+        if not outbox_jobs:
+            st.warning("⚠️ Google Drive and Sheets are not configured. The review was only saved locally.")
+        st.session_state.outbox_jobs = outbox_jobs
+    
+    if st.session_state.outbox_jobs:
+        render_outbox_status()
+    if st.session_state.batch_results:
+        # El envío sigue en el outbox; se puede abrir el siguiente archivo del lote
+        if st.button("⬅️ Back to batch results"): back_to_batch(); st.rerun()
+    st.markdown('</div>', unsafe_allow_html=True)
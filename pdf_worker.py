@@ -0,0 +1,76 @@
+"""
+Tareas de extracción de PDF que corren dentro de los procesos del pool de qa_core.
+
+Este módulo no importa Streamlit ni qa_core: es lo único que cargan los workers, así que
+un proceso nuevo solo paga el import de pypdf.
+"""
+
+import contextlib
+import time
+
+PDF_WORKER_READERS = 2  # Documentos parseados que conserva cada worker
+
+
+class PdfExtractionTimeout(Exception):
+    pass
+
+
+# Ruta -> PdfReader ya parseado (solo existe dentro de cada worker)
+_readers = {}
+
+
+def _reader(path):
+    from pypdf import PdfReader
+    reader = _readers.pop(path, None)
+    if reader is None:
+        reader = PdfReader(path)
+    _readers[path] = reader
+    while len(_readers) > PDF_WORKER_READERS:
+        _readers.pop(next(iter(_readers)))
+    return reader
+
+
+@contextlib.contextmanager
+def _task_alarm(deadline):
+    """Interrumpe la tarea al llegar a `deadline` (time.time()).
+
+    Usa SIGALRM: pypdf es Python puro, así que la señal la corta entre instrucciones. Sin
+    SIGALRM (Windows) solo se revisa el presupuesto entre páginas.
+    """
+    import signal
+    remaining = deadline - time.time()
+    if remaining <= 0:
+        raise PdfExtractionTimeout("PDF extraction time budget exhausted")
+    if not hasattr(signal, "setitimer"):
+        yield
+        return
+
+    def on_alarm(signum, frame):
+        raise PdfExtractionTimeout("PDF extraction ran out of time")
+
+    previous = signal.signal(signal.SIGALRM, on_alarm)
+    signal.setitimer(signal.ITIMER_REAL, remaining)
+    try:
+        yield
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous)
+
+
+def count_pages(path, deadline):
+    """Número de páginas del documento (el parseo queda en caché para las tareas de texto)"""
+    with _task_alarm(deadline):
+        return len(_reader(path).pages)
+
+
+def extract_page_range(path, start, end, deadline):
+    """Texto de las páginas [start, end); las tareas de un documento que ya se pasó de su
+    presupuesto terminan sin trabajar"""
+    texts = []
+    with _task_alarm(deadline):
+        reader = _reader(path)
+        for i in range(start, end):
+            if time.time() > deadline:
+                raise PdfExtractionTimeout("PDF extraction time budget exhausted")
+            texts.append(reader.pages[i].extract_text() or "")
+    return texts
@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+"""
+Runner por lotes (sin navegador) para auditorías de guiones y videos.
+Usa el mismo pipeline que la app (qa_core) y escribe un resultado JSONL por archivo.
+
+Uso:
+    python qa_batch.py guiones/ --campaign "Tecate Pa'l Norte 2025" --output resultados.jsonl
+    python qa_batch.py videos/ --campaign "Tecate Pa'l Norte 2025" --brand Tecate --push
+
+Los secrets se leen de .streamlit/secrets.toml o de variables de entorno
+(GEMINI_API_KEY, GOOGLE_DRIVE_FOLDER_ID, GOOGLE_SHEET_ID, GOOGLE_DRIVE_USER_EMAIL).
+"""
+
+import argparse
+import json
+import mimetypes
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime
+
+from qa_core import (
+    PROMPT_F2,
+    SpoolFullError,
+    VIDEO_JOB_POLL_INTERVAL,
+    analyze_script,
+    configure_gemini,
+    get_video_job_engine,
+    get_review_store,
+    get_video_spool,
+    save_db_record,
+    save_project_files_to_drive,
+)
+
+SCRIPT_EXTENSIONS = {".pdf", ".docx", ".txt"}
+VIDEO_EXTENSIONS = {".mp4", ".mov"}
+
+
+def collect_files(directory):
+    """Guiones y videos del directorio (no recursivo), en orden alfabético"""
+    scripts, videos = [], []
+    for name in sorted(os.listdir(directory)):
+        path = os.path.join(directory, name)
+        if not os.path.isfile(path):
+            continue
+        extension = os.path.splitext(name)[1].lower()
+        if extension in SCRIPT_EXTENSIONS:
+            scripts.append(path)
+        elif extension in VIDEO_EXTENSIONS:
+            videos.append(path)
+    return scripts, videos
+
+
+def new_item(path, kind, args):
+    return {
+        "file": path,
+        "type": kind,
+        "brand": args.brand,
+        "campaign": args.campaign,
+        "influencer": os.path.splitext(os.path.basename(path))[0],
+        "version": args.version,
+        "score": None,
+        "analysis": None,
+        "error": None,
+        "drive_links": [],
+    }
+
+
+def run_script(item, windowed):
+    # Una falla de un archivo se registra en su resultado sin detener el lote
+    try:
+        with open(item["file"], "rb") as f:
+            result, error, _ = analyze_script(f, windowed)
+    except Exception as e:
+        result, error = None, str(e)
+    item["analysis"], item["error"] = result, error
+    return item
+
+
+def submit_video(item, engine, spool):
+    """Copia el video al spool (esperando si está lleno) y lo encola en el motor de jobs"""
+    if os.path.getsize(item["file"]) > spool.max_bytes:
+        item["error"] = "Video is larger than the spool limit"
+        return None
+    while True:
+        try:
+            with open(item["file"], "rb") as f:
+                video_path, content_hash = spool.write(f)
+            return engine.submit(video_path, content_hash, PROMPT_F2)
+        except SpoolFullError:
+            time.sleep(VIDEO_JOB_POLL_INTERVAL)
+
+
+def push_item(item):
+    """Sube el archivo original a Drive, guarda la revisión local y agrega la fila en Sheets"""
+    mime_type = mimetypes.guess_type(item["file"])[0]
+    with open(item["file"], "rb") as f:
+        links = save_project_files_to_drive(
+            item["brand"], item["campaign"], item["influencer"], item["version"],
+            [(os.path.basename(item["file"]), f, mime_type)]
+        )
+    recs = item["analysis"].get("recommendations", [])
+    record = {
+        "TS": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        "Brand": item["brand"],
+        "Camp": item["campaign"],
+        "Inf": item["influencer"],
+        "Ver": item["version"],
+        "Score": item["score"],
+        "Recs": "\n".join(f"- {r}" for r in recs),
+    }
+    review_id = get_review_store().add(
+        record, item["analysis"].get("risks", []), recs,
+        content_type=item["type"], file_name=os.path.basename(item["file"]), reviewer="qa_batch"
+    )
+    get_review_store().set_drive_links(review_id, links)
+    save_db_record(record, links)
+    item["drive_links"] = links
+
+
+def finish_item(item, args, output):
+    """Completa el resultado, lo publica si se pidió y escribe su línea JSONL.
+
+    Devuelve True si el archivo terminó sin errores.
+    """
+    if item["analysis"] is not None:
+        item["score"] = item["analysis"].get("score", 0)
+        if args.push:
+            try:
+                push_item(item)
+            except Exception as e:
+                item["error"] = f"Push failed: {e}"
+    status = f"✅ score {item['score']}" if item["error"] is None else f"❌ {item['error']}"
+    print(f"  {os.path.basename(item['file'])}: {status}")
+    output.write(json.dumps(item, ensure_ascii=False) + "\n")
+    output.flush()
+    return item["error"] is None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Heineken QA Compliance – batch audit runner")
+    parser.add_argument("directory", help="Directory with scripts (PDF, DOCX, TXT) and/or videos (MP4, MOV)")
+    parser.add_argument("--campaign", required=True, help="Campaign name")
+    parser.add_argument("--brand", default="Heineken", help="Heineken brand")
+    parser.add_argument("--version", default="V1 - First Draft", help="Delivery version")
+    parser.add_argument("--output", default="qa_results.jsonl", help="JSONL output file")
+    parser.add_argument("--workers", type=int, default=4, help="Concurrent script analyses")
+    parser.add_argument("--windowed", action="store_true", help="Parallel windowed analysis for long scripts")
+    parser.add_argument("--push", action="store_true", help="Upload originals to Drive and append rows to Sheets")
+    args = parser.parse_args(argv)
+
+    if not configure_gemini():
+        print("❌ GEMINI_API_KEY is not set (secrets.toml or environment)")
+        return 2
+
+    scripts, videos = collect_files(args.directory)
+    print(f"📂 {len(scripts)} script(s) and {len(videos)} video(s) in {args.directory}")
+    failures = 0
+
+    with open(args.output, "a", encoding="utf-8") as output:
+        # Los videos van al motor de jobs (su propio pool) mientras los guiones usan este
+        engine = get_video_job_engine() if videos else None
+        pending_videos = {}
+        for path in videos:
+            item = new_item(path, "video", args)
+            job_id = submit_video(item, engine, get_video_spool())
+            if job_id is None:
+                failures += not finish_item(item, args, output)
+            else:
+                pending_videos[job_id] = item
+
+        with ThreadPoolExecutor(max_workers=args.workers) as executor:
+            futures = [executor.submit(run_script, new_item(path, "script", args), args.windowed) for path in scripts]
+            for future in as_completed(futures):
+                failures += not finish_item(future.result(), args, output)
+
+        while pending_videos:
+            for job_id, item in list(pending_videos.items()):
+                job = engine.get(job_id)
+                if job is None:
+                    item["error"] = "Video job was lost"
+                elif job["state"] in ("done", "failed"):
+                    item["analysis"], item["error"] = job["result"], job["error"]
+                else:
+                    continue
+                failures += not finish_item(item, args, output)
+                del pending_videos[job_id]
+            if pending_videos:
+                time.sleep(VIDEO_JOB_POLL_INTERVAL)
+
+    print(f"✅ Done. {len(scripts) + len(videos) - failures} ok, {failures} failed. Results in {args.output}")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,2874 @@
+"""Lógica central de Heineken QA Compliance (sin UI).
+
+Extracción de texto, análisis con Gemini, Drive/Docs/Sheets y jobs de video.
+La usan tanto la app de Streamlit (app.py) como el runner por lotes (qa_batch.py).
+"""
+import streamlit as st
+from streamlit.runtime.scriptrunner import get_script_run_ctx
+import importlib.util
+import json
+import time
+from datetime import datetime
+import os
+import io
+import hashlib
+import threading
+import uuid
+import shutil
+import random
+import multiprocessing
+import contextlib
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+import pdf_worker
+from pdf_worker import PdfExtractionTimeout
+
+# Las dependencias pesadas (Gemini, Google APIs, pypdf, python-docx) se importan dentro de
+# las funciones que las usan: el arranque en frío solo paga por lo que la sesión necesita.
+# Ver startup_report.py para el desglose del costo de importación.
+
+# Google Services: se verifica que estén instaladas sin importarlas
+GOOGLE_SERVICES_AVAILABLE = all(
+    importlib.util.find_spec(module) is not None
+    for module in ("gspread", "googleapiclient", "google.oauth2", "google_auth_httplib2", "httplib2")
+)
+
+# --- CONFIGURACIÓN Y ENTORNO ---
+def get_secret(name, default=None):
+    """Lee un valor de st.secrets (app) o, si no está, de las variables de entorno (CLI)"""
+    try:
+        value = st.secrets.get(name)
+    except Exception:
+        # Sin secrets.toml (p.ej. corriendo qa_batch.py fuera de Streamlit)
+        value = None
+    if value is None:
+        value = os.environ.get(name, default)
+    return value
+
+def notify(level, message):
+    """Muestra el mensaje en la UI si hay una sesión de Streamlit activa; si no, lo imprime"""
+    if get_script_run_ctx(suppress_warning=True) is not None:
+        getattr(st, level)(message)
+    else:
+        print(message)
+
+def configure_gemini():
+    """Configura la API key de Gemini; devuelve False si no está definida"""
+    api_key = get_secret("GEMINI_API_KEY")
+    if not api_key:
+        return False
+    import google.generativeai as genai
+    genai.configure(api_key=api_key)
+    return True
+
+def process_singleton(factory):
+    """Decorador: la fábrica se ejecuta una sola vez por proceso (sobrevive a los reruns)"""
+    lock = threading.Lock()
+    instance = []
+
+    def get_instance():
+        if not instance:
+            with lock:
+                if not instance:
+                    instance.append(factory())
+        return instance[0]
+
+    get_instance.__name__ = factory.__name__
+    get_instance.__doc__ = factory.__doc__
+    return get_instance
+
+# ESTADO LOCAL
+def write_json_atomic(path, data):
+    """Escribe JSON vía archivo temporal + os.replace para que nadie lea un archivo a medias"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+def write_bytes_atomic(path, data):
+    """Como write_json_atomic para bytes: reemplaza el archivo (nuevo inode) en lugar de
+    reescribirlo, así los hard links que ya existen conservan el contenido anterior"""
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+# GOOGLE DRIVE & DOCS
+SCOPE = [
+    'https://spreadsheets.google.com/feeds', 
+    'https://www.googleapis.com/auth/drive',
+    'https://www.googleapis.com/auth/documents'
+]
+GOOGLE_HTTP_TIMEOUT = 120  # Segundos por petición HTTP
+
+class GoogleClientRegistry:
+    """Clientes de Drive, Docs y Sheets compartidos por todo el proceso.
+
+    Las credenciales se leen una sola vez y se comparten entre clientes, así que el
+    access token se reutiliza hasta que expira (google-auth lo refresca solo).
+    Los documentos de discovery salen de la copia estática de googleapiclient y cada
+    hilo usa su propio transporte HTTP, porque httplib2 no es thread-safe.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._base_credentials = None
+        self._credentials = None
+        self._services = {}
+        self._gspread_client = None
+
+    def base_credentials(self):
+        """Credenciales de la cuenta de servicio sin delegación (las que usa Sheets)"""
+        with self._lock:
+            if self._base_credentials is None:
+                from google.oauth2 import service_account
+                self._base_credentials = service_account.Credentials.from_service_account_file("credentials.json", scopes=SCOPE)
+            return self._base_credentials
+
+    def credentials(self):
+        """Credenciales para Drive y Docs, con delegación si está configurada"""
+        base = self.base_credentials()
+        with self._lock:
+            if self._credentials is None:
+                creds = base
+                # Intentar usar domain-wide delegation si está configurado
+                # Esto permite que la cuenta de servicio actúe en nombre de un usuario real
+                # que sí tiene cuota de almacenamiento
+                user_email = get_secret("GOOGLE_DRIVE_USER_EMAIL")
+                if user_email:
+                    print(f"🔐 Usando domain-wide delegation para: {user_email}")
+                    creds = creds.with_subject(user_email)
+                self._credentials = creds
+            return self._credentials
+
+    def thread_http(self):
+        """Transporte autorizado propio del hilo actual"""
+        http = getattr(self._local, "http", None)
+        if http is None:
+            import google_auth_httplib2
+            import httplib2
+            http = google_auth_httplib2.AuthorizedHttp(
+                self.credentials(), http=httplib2.Http(timeout=GOOGLE_HTTP_TIMEOUT)
+            )
+            self._local.http = http
+        return http
+
+    def _build_request(self, http, *args, **kwargs):
+        # Ignora el transporte con el que se construyó el servicio y usa el del hilo que ejecuta
+        from googleapiclient.http import HttpRequest
+        return HttpRequest(self.thread_http(), *args, **kwargs)
+
+    def service(self, name, version):
+        """Devuelve (construyendo una sola vez) el cliente de la API indicada"""
+        key = (name, version)
+        service = self._services.get(key)
+        if service is None:
+            credentials = self.credentials()
+            with self._lock:
+                service = self._services.get(key)
+                if service is None:
+                    from googleapiclient.discovery import build
+                    import google_auth_httplib2
+                    import httplib2
+                    service = build(
+                        name, version,
+                        http=google_auth_httplib2.AuthorizedHttp(credentials, http=httplib2.Http(timeout=GOOGLE_HTTP_TIMEOUT)),
+                        requestBuilder=self._build_request,
+                        static_discovery=True,
+                        cache_discovery=False
+                    )
+                    self._services[key] = service
+                    print(f"✅ Cliente {name} {version} inicializado")
+        return service
+
+    def gspread_client(self):
+        credentials = self.base_credentials()
+        with self._lock:
+            if self._gspread_client is None:
+                import gspread
+                self._gspread_client = gspread.authorize(credentials)
+            return self._gspread_client
+
+@process_singleton
+def get_google_clients():
+    """Registro único por proceso"""
+    return GoogleClientRegistry()
+
+def get_drive_service():
+    """Obtiene el servicio de Google Drive con domain-wide delegation si está configurado"""
+    if not GOOGLE_SERVICES_AVAILABLE:
+        print("❌ Google Services no están disponibles (librerías no instaladas)")
+        return None
+    if not os.path.exists("credentials.json"):
+        print("❌ Archivo credentials.json no encontrado")
+        return None
+    try:
+        return get_google_clients().service('drive', 'v3')
+    except Exception as e:
+        print(f"❌ Error al inicializar servicio de Drive: {e}")
+    return None
+
+def test_drive_connection():
+    """Función de prueba para verificar la conexión con Google Drive"""
+    results = {
+        "service_available": False,
+        "credentials_file_exists": False,
+        "api_enabled": False,
+        "folder_accessible": False,
+        "error_messages": []
+    }
+    
+    # Verificar si las librerías están disponibles
+    if not GOOGLE_SERVICES_AVAILABLE:
+        results["error_messages"].append("❌ Google libraries are not installed")
+        return results
+    
+    # Verificar si existe el archivo de credenciales
+    if os.path.exists("credentials.json"):
+        results["credentials_file_exists"] = True
+        print("✅ Archivo credentials.json encontrado")
+    else:
+        results["error_messages"].append("❌ credentials.json file not found in current directory")
+        return results
+    
+    # Intentar obtener el servicio
+    try:
+        service = get_drive_service()
+        if service:
+            results["service_available"] = True
+            print("✅ Servicio de Drive creado exitosamente")
+        else:
+            results["error_messages"].append("❌ Could not create Drive service")
+            return results
+    except Exception as e:
+        results["error_messages"].append(f"❌ Error creating service: {str(e)}")
+        return results
+    
+    # Verificar si la API está habilitada intentando hacer una operación simple
+    try:
+        # Intentar listar archivos (operación básica)
+        about = service.about().get(fields='user,storageQuota').execute()
+        results["api_enabled"] = True
+        print(f"✅ API de Drive habilitada. Usuario: {about.get('user', {}).get('emailAddress', 'N/A')}")
+    except Exception as e:
+        error_str = str(e)
+        if "403" in error_str or "accessNotConfigured" in error_str or "API has not been used" in error_str:
+            results["error_messages"].append("❌ Google Drive API is not enabled. Go to: https://console.cloud.google.com/apis/library/drive.googleapis.com")
+        else:
+            results["error_messages"].append(f"❌ Error verifying API: {error_str}")
+        return results
+    
+    # Verificar acceso a la carpeta raíz o Shared Drive
+    try:
+        root_id = get_secret("GOOGLE_DRIVE_FOLDER_ID")
+        if not root_id:
+            results["error_messages"].append("❌ GOOGLE_DRIVE_FOLDER_ID is not set in secrets")
+            return results
+        
+        # Detectar si es Shared Drive (los IDs de Shared Drives empiezan con 0A)
+        is_shared_drive = root_id.startswith('0A') and len(root_id) > 10
+        
+        if is_shared_drive:
+            # Para Shared Drives, usar drives().get()
+            try:
+                drive = service.drives().get(
+                    driveId=root_id,
+                    fields='id,name'
+                ).execute()
+                results["folder_accessible"] = True
+                print(f"✅ Shared Drive accesible: {drive.get('name', 'N/A')} (ID: {root_id})")
+            except Exception as drive_error:
+                error_str = str(drive_error)
+                if "404" in error_str:
+                    results["error_messages"].append(f"❌ Shared Drive with ID '{root_id}' does not exist or the service account is not a member")
+                elif "403" in error_str:
+                    results["error_messages"].append("❌ No permission. Ensure the service account is a member of the Shared Drive (check your service account email in Google Cloud Console).")
+                else:
+                    results["error_messages"].append(f"❌ Error accessing Shared Drive: {error_str}")
+        else:
+            # Para carpetas normales
+            folder = service.files().get(
+                fileId=root_id,
+                fields='id,name,permissions',
+                supportsAllDrives=True
+            ).execute()
+            results["folder_accessible"] = True
+            print(f"✅ Carpeta accesible: {folder.get('name', 'N/A')} (ID: {root_id})")
+    except Exception as e:
+        error_str = str(e)
+        if "404" in error_str:
+            results["error_messages"].append(f"❌ Folder/Shared Drive with ID '{root_id}' does not exist or you do not have access")
+        elif "403" in error_str:
+            results["error_messages"].append(f"❌ No permission. Ensure the service account has access")
+        else:
+            results["error_messages"].append(f"❌ Error accessing: {error_str}")
+    
+    return results
+
+def find_or_create_folder(drive_service, folder_name, parent_id):
+    """Busca o crea una carpeta, soportando Shared Drives"""
+    # Detectar si es un Shared Drive (los IDs de Shared Drives empiezan con 0A)
+    is_shared_drive = parent_id.startswith('0A') and len(parent_id) > 10
+    
+    query = f"mimeType='application/vnd.google-apps.folder' and name='{folder_name}' and '{parent_id}' in parents and trashed=false"
+    
+    # Parámetros necesarios para Shared Drives
+    list_params = {
+        'q': query,
+        'fields': 'files(id)',
+        'supportsAllDrives': True,
+        'includeItemsFromAllDrives': True
+    }
+    
+    results = drive_service.files().list(**list_params).execute()
+    files = results.get('files', [])
+    
+    if files:
+        return files[0]['id']
+    else:
+        # Crear nueva carpeta
+        file_metadata = {
+            'name': folder_name,
+            'mimeType': 'application/vnd.google-apps.folder',
+            'parents': [parent_id]
+        }
+        
+        # Parámetros para crear en Shared Drive
+        create_params = {
+            'body': file_metadata,
+            'fields': 'id',
+            'supportsAllDrives': True
+        }
+        
+        folder = drive_service.files().create(**create_params).execute()
+        return folder.get('id')
+
+# CACHÉ DE CARPETAS
+# Mapa persistente (parent_id, nombre) -> folder_id. Las entradas se confían sin consultar
+# a Drive solo durante FOLDER_CACHE_VERIFY_INTERVAL; pasado ese tiempo se re-verifica la
+# carpeta más profunda del camino (un files().get) para detectar carpetas en la papelera.
+FOLDER_CACHE_PATH = os.path.join(".qa_cache", "drive_folders.json")
+FOLDER_CACHE_VERIFY_INTERVAL = 10 * 60  # Segundos
+
+class FolderPathCache:
+    """Caché de IDs de carpetas de Drive que persiste entre sesiones y reinicios"""
+
+    def __init__(self, path=FOLDER_CACHE_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._entries = {}
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                self._entries = json.load(f)
+        except (OSError, ValueError):
+            self._entries = {}
+
+    @staticmethod
+    def _key(parent_id, name):
+        # Los IDs de Drive nunca contienen "/", así que el nombre puede llevar cualquier carácter
+        return f"{parent_id}/{name}"
+
+    def get(self, parent_id, name):
+        with self._lock:
+            return self._entries.get(self._key(parent_id, name))
+
+    def put(self, parent_id, name, folder_id):
+        with self._lock:
+            self._entries[self._key(parent_id, name)] = {"id": folder_id, "verified": time.time()}
+            self._save()
+
+    def discard(self, parent_id, name):
+        with self._lock:
+            if self._entries.pop(self._key(parent_id, name), None) is not None:
+                self._save()
+
+    def _save(self):
+        try:
+            write_json_atomic(self.path, self._entries)
+        except Exception as e:
+            print(f"⚠️ No se pudo guardar la caché de carpetas: {e}")
+
+@process_singleton
+def get_folder_cache():
+    return FolderPathCache()
+
+def is_folder_alive(drive_service, folder_id, parent_id):
+    """Comprueba que la carpeta exista, no esté en la papelera y siga bajo el mismo padre"""
+    try:
+        folder = drive_service.files().get(
+            fileId=folder_id,
+            fields='id, trashed, parents',
+            supportsAllDrives=True
+        ).execute()
+    except Exception as e:
+        print(f"⚠️ Carpeta en caché no disponible ({folder_id}): {e}")
+        return False
+    return not folder.get('trashed') and parent_id in folder.get('parents', [])
+
+def resolve_folder_path(drive_service, root_id, names, refresh=False):
+    """Resuelve root -> names[0] -> names[1] ... usando la caché de carpetas.
+
+    Con refresh=True se ignoran las entradas en caché (p.ej. después de un 404 al
+    subir a una carpeta que ya no existe) y se consulta Drive nivel por nivel.
+    """
+    cache = get_folder_cache()
+    # Prefijo del camino que ya está en caché
+    cached = []
+    parent_id = root_id
+    for name in ([] if refresh else names):
+        entry = cache.get(parent_id, name)
+        if not entry:
+            break
+        cached.append((parent_id, name, entry))
+        parent_id = entry["id"]
+
+    if any(time.time() - entry.get("verified", 0) >= FOLDER_CACHE_VERIFY_INTERVAL for _, _, entry in cached):
+        # Mandar una carpeta a la papelera marca también a sus descendientes, así que basta
+        # con verificar la más profunda para validar todo el prefijo
+        deepest_parent, _, deepest = cached[-1]
+        if is_folder_alive(drive_service, deepest["id"], deepest_parent):
+            for level_parent, name, entry in cached:
+                cache.put(level_parent, name, entry["id"])
+        else:
+            for level_parent, name, _ in cached:
+                cache.discard(level_parent, name)
+            cached = []
+
+    parent_id = cached[-1][2]["id"] if cached else root_id
+    for name in names[len(cached):]:
+        folder_id = find_or_create_folder(drive_service, name, parent_id)
+        cache.put(parent_id, name, folder_id)
+        parent_id = folder_id
+    return parent_id
+
+def is_not_found_error(error):
+    """True si el error de la API indica que el recurso (p.ej. la carpeta destino) no existe"""
+    status = getattr(getattr(error, 'resp', None), 'status', None)
+    return status == 404 or "File not found" in str(error)
+
+# SUBIDAS RESUMABLES
+# Los archivos se suben por partes; la URI de la sesión se guarda en disco para continuar
+# desde el último byte confirmado después de un corte o de un reinicio del proceso.
+DRIVE_UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024  # Debe ser múltiplo de 256 KB
+UPLOAD_SESSIONS_PATH = os.path.join(".qa_cache", "drive_upload_sessions.json")
+UPLOAD_SESSION_TTL = 6 * 24 * 3600  # Drive invalida las sesiones después de una semana
+
+class UploadSessionStore:
+    """URIs de sesiones resumables de Drive por llave de subida, persistidas entre reinicios"""
+
+    def __init__(self, path=UPLOAD_SESSIONS_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._entries = {}
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                self._entries = json.load(f)
+        except (OSError, ValueError):
+            self._entries = {}
+
+    def get(self, key, folder_id):
+        """URI vigente de la llave (None si no hay, expiró o era para otra carpeta)"""
+        with self._lock:
+            entry = self._entries.get(key)
+        if not entry:
+            return None
+        if entry["folder_id"] != folder_id or time.time() - entry["created"] > UPLOAD_SESSION_TTL:
+            self.discard(key)
+            return None
+        return entry["uri"]
+
+    def put(self, key, folder_id, uri):
+        with self._lock:
+            self._entries[key] = {"uri": uri, "folder_id": folder_id, "created": time.time()}
+            self._save()
+
+    def discard(self, key):
+        with self._lock:
+            if self._entries.pop(key, None) is not None:
+                self._save()
+
+    def _save(self):
+        try:
+            write_json_atomic(self.path, self._entries)
+        except Exception as e:
+            print(f"⚠️ No se pudieron guardar las sesiones de subida: {e}")
+
+@process_singleton
+def get_upload_sessions():
+    return UploadSessionStore()
+
+def query_upload_session(uri, total_size):
+    """Pregunta a Drive cuánto recibió una sesión resumable.
+
+    Devuelve (bytes confirmados, None), (total, archivo) si la subida ya había terminado,
+    o None si la sesión ya no sirve y hay que empezar de cero.
+    """
+    http = get_google_clients().thread_http()
+    resp, content = http.request(uri, "PUT", headers={"Content-Length": "0", "Content-Range": f"bytes */{total_size}"})
+    if resp.status in (200, 201):
+        return total_size, json.loads(content)
+    if resp.status == 308:
+        # "Range: bytes=0-N" con el último byte confirmado; sin Range no llegó nada
+        received = resp.get("range")
+        return (int(received.rsplit("-", 1)[1]) + 1 if received else 0), None
+    return None
+
+def upload_file_to_drive(drive_service, file_obj, filename, folder_id, mime_type=None,
+                         chunk_size=DRIVE_UPLOAD_CHUNK_SIZE, on_progress=None, resume_key=None):
+    """Sube un archivo a Drive por partes, soportando Shared Drives.
+
+    on_progress(bytes confirmados, total) se llama después de cada parte. Con resume_key la
+    sesión se persiste y un nuevo intento con la misma llave continúa donde se quedó.
+    """
+    from googleapiclient.http import MediaIoBaseUpload
+    media = MediaIoBaseUpload(file_obj, mimetype=mime_type, chunksize=chunk_size, resumable=True)
+    file_metadata = {'name': filename, 'parents': [folder_id]}
+    
+    # Parámetros necesarios para Shared Drives
+    create_params = {
+        'body': file_metadata,
+        'media_body': media,
+        'fields': 'id, webViewLink',
+        'supportsAllDrives': True
+    }
+    
+    request = drive_service.files().create(**create_params)
+    total_size = media.size()
+    sessions = get_upload_sessions()
+    
+    saved_uri = sessions.get(resume_key, folder_id) if resume_key else None
+    if saved_uri:
+        state = query_upload_session(saved_uri, total_size)
+        if state is None:
+            print(f"  ♻️ Sesión de subida expirada para {filename}; empezando de cero")
+            sessions.discard(resume_key)
+            saved_uri = None
+        elif state[1] is not None:
+            sessions.discard(resume_key)
+            return state[1]
+        else:
+            print(f"  ⏯️ Reanudando {filename} desde el byte {state[0]:,} de {total_size:,}")
+            request.resumable_uri = saved_uri
+            request.resumable_progress = state[0]
+            if on_progress:
+                on_progress(state[0], total_size)
+    
+    file = None
+    while file is None:
+        status, file = request.next_chunk()
+        if resume_key and not saved_uri and request.resumable_uri:
+            saved_uri = request.resumable_uri
+            sessions.put(resume_key, folder_id, saved_uri)
+        if status and on_progress:
+            on_progress(status.resumable_progress, total_size)
+    
+    if resume_key:
+        sessions.discard(resume_key)
+    if on_progress:
+        on_progress(total_size, total_size)
+    return file
+
+# REPORTE
+DOCX_MIME_TYPE = "application/vnd.openxmlformats-officedocument.wordprocessingml.document"
+GOOGLE_DOC_MIME_TYPE = "application/vnd.google-apps.document"
+
+def render_report_docx(report):
+    """Arma el reporte de revisión como .docx (encabezados, tabla del proyecto y de hallazgos).
+
+    `report` trae brand, campaign, influencer, version, score, reviewer, date, content_type,
+    risks (como los entrega Gemini), recommendations (texto final) y email.
+    """
+    from docx import Document
+    doc = Document()
+    doc.add_heading(f"Review Report - {report['campaign']}", 0)
+    
+    doc.add_heading("Project Information", 1)
+    info = [
+        ("Brand", report["brand"]),
+        ("Campaign", report["campaign"]),
+        ("Influencer", report["influencer"]),
+        ("Version", report["version"]),
+        ("Score", f"{report['score']}/100"),
+        ("Reviewed by", report["reviewer"]),
+        ("Date", report["date"]),
+    ]
+    table = doc.add_table(rows=0, cols=2)
+    table.style = "Table Grid"
+    for label, value in info:
+        cells = table.add_row().cells
+        cells[0].text = label
+        cells[0].paragraphs[0].runs[0].bold = True
+        cells[1].text = str(value)
+    
+    doc.add_heading("Findings", 1)
+    risks = report["risks"]
+    if risks:
+        is_video = report["content_type"] == "video"
+        headers = ["#", "Risk", "Time" if is_video else "Quote", "Explanation"]
+        table = doc.add_table(rows=1, cols=len(headers))
+        table.style = "Table Grid"
+        for cell, header in zip(table.rows[0].cells, headers):
+            cell.text = header
+            cell.paragraphs[0].runs[0].bold = True
+        for i, risk in enumerate(risks, 1):
+            cells = table.add_row().cells
+            cells[0].text = str(i)
+            cells[1].text = risk.get("risk", "")
+            cells[2].text = risk.get("timestamp", "") if is_video else risk.get("quote", "")
+            cells[3].text = risk.get("explanation", "")
+    else:
+        doc.add_paragraph("No critical risks detected.")
+    
+    doc.add_heading("Recommendations", 1)
+    for line in report["recommendations"].splitlines():
+        line = line.strip()
+        if line:
+            doc.add_paragraph(line.lstrip("-•* ").strip(), style="List Bullet")
+    
+    doc.add_heading("Final Email", 1)
+    for paragraph in report["email"].split("\n\n"):
+        doc.add_paragraph(paragraph.strip())
+    doc.add_paragraph(report["reviewer"])
+    
+    buffer = io.BytesIO()
+    doc.save(buffer)
+    buffer.seek(0)
+    return buffer
+
+def create_google_doc(drive_service, title, report, folder_id):
+    """Crea el reporte como Google Doc en la carpeta indicada, en una sola llamada a Drive:
+    el .docx armado localmente se sube con conversión a Google Docs. Lanza el error de la API."""
+    from googleapiclient.http import MediaIoBaseUpload
+    media = MediaIoBaseUpload(render_report_docx(report), mimetype=DOCX_MIME_TYPE, resumable=False)
+    return drive_service.files().create(
+        body={'name': title, 'mimeType': GOOGLE_DOC_MIME_TYPE, 'parents': [folder_id]},
+        media_body=media,
+        fields='id, webViewLink',
+        supportsAllDrives=True
+    ).execute()
+
+# Subidas simultáneas por envío; cada hilo usa su propio transporte (GoogleClientRegistry)
+DRIVE_UPLOAD_WORKERS = 4
+# Evita que dos subidas que encuentran la carpeta obsoleta la re-creen por duplicado
+_folder_refresh_lock = threading.Lock()
+
+def with_version_folder(service, root_id, folder_path, ver_id, create):
+    """Ejecuta create(id de carpeta); si la carpeta en caché ya no existe (404), la resuelve
+    de nuevo contra Drive y reintenta una vez. Devuelve (resultado, id de carpeta vigente)."""
+    try:
+        return create(ver_id), ver_id
+    except Exception as error:
+        if not is_not_found_error(error):
+            raise
+        # La carpeta en caché ya no existe: resolver de nuevo contra Drive y reintentar
+        print(f"  ♻️ Carpeta en caché obsoleta, resolviendo de nuevo: {error}")
+        with _folder_refresh_lock:
+            ver_id = resolve_folder_path(service, root_id, folder_path, refresh=True)
+        return create(ver_id), ver_id
+
+def upload_to_version_folder(service, root_id, folder_path, ver_id, name, data, mime, **upload_options):
+    """Sube un archivo a la carpeta de versión (ver with_version_folder). Devuelve (archivo,
+    id de carpeta vigente).
+
+    upload_options se pasan a upload_file_to_drive (on_progress, resume_key, chunk_size).
+    """
+    def upload(folder_id):
+        # Asegurar que el objeto de archivo esté en el inicio (también en el reintento)
+        if hasattr(data, 'seek'):
+            data.seek(0)
+        return upload_file_to_drive(service, data, name, folder_id, mime, **upload_options)
+    return with_version_folder(service, root_id, folder_path, ver_id, upload)
+
+def save_project_files_to_drive(brand, campaign, influencer, version, files):
+    """Guarda archivos en Drive con jerarquía: Campaña -> Influencer -> Versión"""
+    if not GOOGLE_SERVICES_AVAILABLE: 
+        notify("error", "❌ Google Services are not available")
+        return []
+    
+    uploaded_links = []
+    try:
+        print("🔍 Iniciando guardado en Drive...")
+        service = get_drive_service()
+        root_id = get_secret("GOOGLE_DRIVE_FOLDER_ID")
+        
+        if not service:
+            notify("error", "⚠️ Could not create Google Drive service. Check credentials.json")
+            return []
+        
+        if not root_id:
+            notify("error", "⚠️ GOOGLE_DRIVE_FOLDER_ID is not set in secrets.toml")
+            return []
+        
+        print(f"📁 Carpeta raíz ID: {root_id}")
+        
+        # Jerarquía: Campaña -> Influencer -> Versión (sin Brand)
+        print(f"📂 Creando estructura: {campaign} -> {influencer} -> {version}")
+        folder_path = [campaign, influencer, version]
+        ver_id = resolve_folder_path(service, root_id, folder_path)
+        print(f"✅ Carpeta de versión creada/encontrada: {ver_id}")
+        
+        # Subir archivos a la carpeta de versión, en paralelo y aislando las fallas por archivo
+        print(f"📤 Subiendo {len(files)} archivo(s)...")
+        def upload_one(i, name, data, mime):
+            print(f"  📄 Subiendo archivo {i}/{len(files)}: {name}")
+            try:
+                f, file_ver_id = upload_to_version_folder(service, root_id, folder_path, ver_id, name, data, mime)
+            except Exception as file_error:
+                print(f"  ❌ Error al subir {name}: {file_error}")
+                return "", None, file_error
+            link = f.get('webViewLink', '')
+            if link:
+                print(f"  ✅ Archivo subido: {link}")
+            else:
+                print(f"  ⚠️ Archivo subido pero sin link")
+            return link, file_ver_id, None
+        
+        with ThreadPoolExecutor(max_workers=max(1, min(DRIVE_UPLOAD_WORKERS, len(files)))) as executor:
+            futures = [executor.submit(upload_one, i, name, data, mime) for i, (name, data, mime) in enumerate(files, 1)]
+            results = [future.result() for future in futures]
+        
+        # Los links conservan el orden de `files` (columnas de Sheets); una falla deja su lugar vacío
+        for (name, _, _), (link, file_ver_id, file_error) in zip(files, results):
+            if file_ver_id:
+                ver_id = file_ver_id
+            if file_error is not None:
+                # notify desde este hilo: los workers no tienen contexto de Streamlit
+                notify("warning", f"⚠️ Could not upload file {name}: {str(file_error)}")
+            uploaded_links.append(link)
+        
+        # Retornar también el link de la carpeta de versión para fácil acceso
+        folder_link = f"https://drive.google.com/drive/folders/{ver_id}"
+        uploaded_links.insert(0, folder_link)  # Agregar al inicio como link principal
+        print(f"✅ Proceso completado. {sum(1 for link in uploaded_links if link)} link(s) generado(s)")
+            
+    except Exception as e: 
+        error_msg = str(e)
+        print(f"Drive Upload Error: {e}")
+        
+        # Mensaje de error más amigable y específico
+        if "403" in error_msg or "accessNotConfigured" in error_msg or "API has not been used" in error_msg:
+            notify("error", """
+            **❌ Error: Google Drive API is not enabled**
+            
+            To fix this:
+            
+            1. Go to: https://console.cloud.google.com/apis/library/drive.googleapis.com
+            2. Select your project (or create it if it doesn't exist)
+            3. Click "ENABLE"
+            4. Wait a few minutes and try again
+            
+            **Note:** Ensure the service account has permissions to access Drive.
+            """)
+        elif "401" in error_msg or "credentials" in error_msg.lower():
+            notify("error", """
+            **❌ Google Drive authentication error**
+            
+            Verify that:
+            - The `credentials.json` file exists and is valid
+            - The service account has permissions in Drive
+            - The service account permissions include access to the root folder
+            """)
+        else:
+            notify("error", f"""
+            **❌ Error uploading files to Drive**
+            
+            Details: {error_msg}
+            
+            Check your connection and Google Drive credentials.
+            """)
+        
+    return uploaded_links
+
+# TEXT EXTRACTION
+def iter_paragraphs(pages):
+    """Une líneas fragmentadas en párrafos (conversiones malas de PDF/DOCX).
+
+    Recibe (número de página, texto) en orden y produce (página donde empieza, párrafo)
+    conforme avanza, sin armar el documento completo en memoria.
+    """
+    buffer = ""
+    buffer_page = None
+    
+    for page_number, text in pages:
+        for line in text.split('\n'):
+            line = line.strip()
+            
+            if not line:
+                # Only flush if the buffer seems to be a complete sentence/header
+                if buffer and buffer.endswith(('.', '!', '?', ':')):
+                    yield buffer_page, buffer
+                    buffer = ""
+                # Otherwise, assume it's an intra-paragraph break (double spacing) and keep buffer
+                continue
+                
+            # If we have a buffer, check if we should merge
+            if buffer:
+                 buffer += " " + line
+            else:
+                buffer = line
+                buffer_page = page_number
+            
+    if buffer: yield buffer_page, buffer
+
+def reconstruct_paragraphs(text):
+    """Merges fragmented lines into paragraphs (handles bad PDF/DOCX conversions)."""
+    return "\n".join(paragraph for _, paragraph in iter_paragraphs([(1, text)]))
+
+# EXTRACCIÓN DE PDF EN PARALELO
+# Las páginas se reparten en bloques entre procesos (pypdf es CPU puro y no suelta el GIL)
+# y se consumen en orden conforme terminan. El PDF se escribe una vez a un archivo temporal:
+# las tareas (pdf_worker) solo llevan la ruta y cada worker parsea el documento una vez. El
+# presupuesto de tiempo, incluido el conteo de páginas, se aplica dentro de cada tarea, así
+# un PDF atorado no afecta a los demás.
+PDF_EXTRACT_WORKERS = min(4, os.cpu_count() or 1)
+PDF_PAGES_PER_TASK = 8
+PDF_EXTRACT_TIME_BUDGET = 120  # Segundos por documento
+PDF_EXTRACT_GRACE = 5  # Margen para que un worker reporte su propio timeout
+
+class NeutralMainProcessPool(ProcessPoolExecutor):
+    """ProcessPoolExecutor cuyos workers no vuelven a importar el __main__ del padre.
+
+    Streamlit registra app.py como __main__ con __file__ y sin __spec__; con "spawn" cada
+    worker lo re-ejecutaría completo (y repetiría sus efectos al arrancar). Mientras se crea
+    cada proceso, __main__ se sustituye por un módulo vacío.
+    """
+
+    _main_lock = threading.Lock()
+
+    def _spawn_process(self):
+        import sys
+        import types
+        with self._main_lock:
+            main_module = sys.modules.get("__main__")
+            neutral_main = types.ModuleType("__main__")
+            sys.modules["__main__"] = neutral_main
+            try:
+                super()._spawn_process()
+            finally:
+                # Si un rerun de Streamlit registró su propio __main__ mientras tanto, se respeta
+                if sys.modules.get("__main__") is neutral_main:
+                    sys.modules["__main__"] = main_module
+
+class PdfExtractionPool:
+    """Pool de procesos compartido; se recrea solo si un worker murió (BrokenProcessPool)"""
+
+    def __init__(self, max_workers):
+        self.max_workers = max_workers
+        self._lock = threading.Lock()
+        self._executor = None
+
+    def executor(self):
+        with self._lock:
+            if self._executor is None:
+                # "spawn": hacer fork de un servidor con hilos puede dejar locks tomados
+                self._executor = NeutralMainProcessPool(
+                    max_workers=self.max_workers, mp_context=multiprocessing.get_context("spawn")
+                )
+            return self._executor
+
+    def discard(self, executor):
+        """Descarta un pool roto para que la siguiente extracción cree uno nuevo"""
+        with self._lock:
+            if self._executor is not executor:
+                return
+            self._executor = None
+        executor.shutdown(wait=False, cancel_futures=True)
+
+@process_singleton
+def get_pdf_extraction_pool():
+    return PdfExtractionPool(PDF_EXTRACT_WORKERS)
+
+def iter_pdf_pages(pdf_bytes, time_budget=PDF_EXTRACT_TIME_BUDGET):
+    """Produce (número de página, texto) en orden, extrayendo en paralelo en el pool"""
+    from concurrent.futures.process import BrokenProcessPool
+    import tempfile
+    deadline = time.time() + time_budget
+    fd, path = tempfile.mkstemp(suffix=".pdf")
+    with os.fdopen(fd, "wb") as f:
+        f.write(pdf_bytes)
+    pool = get_pdf_extraction_pool()
+    executor = pool.executor()
+    futures = []
+
+    def result(future):
+        try:
+            return future.result(timeout=max(deadline - time.time(), 0) + PDF_EXTRACT_GRACE)
+        except (FutureTimeoutError, PdfExtractionTimeout):
+            # Los workers abandonan solos el resto del documento; el pool sigue sano
+            raise PdfExtractionTimeout(f"PDF text extraction took longer than {time_budget}s and was stopped")
+        except BrokenProcessPool:
+            pool.discard(executor)
+            raise
+
+    try:
+        page_count = result(executor.submit(pdf_worker.count_pages, path, deadline))
+        futures = [
+            (start, executor.submit(pdf_worker.extract_page_range, path, start, min(start + PDF_PAGES_PER_TASK, page_count), deadline))
+            for start in range(0, page_count, PDF_PAGES_PER_TASK)
+        ]
+        for start, future in futures:
+            for offset, text in enumerate(result(future)):
+                yield start + offset + 1, text
+    finally:
+        for _, future in futures:
+            future.cancel()
+        # Los workers ya tienen el documento en memoria (o no lo van a necesitar)
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+def extract_paragraphs(uploaded_file):
+    """Párrafos del documento con su número de página: [(página, párrafo)] (DOCX/TXT: página 1)"""
+    if uploaded_file.name.endswith('.pdf'):
+        uploaded_file.seek(0)
+        pages = iter_pdf_pages(uploaded_file.read())
+    elif uploaded_file.name.endswith('.docx'):
+        from docx import Document
+        doc = Document(uploaded_file)
+        pages = [(1, "\n".join([p.text for p in doc.paragraphs]))]
+    else: # txt
+        uploaded_file.seek(0)
+        pages = [(1, uploaded_file.read().decode("utf-8"))]
+    return list(iter_paragraphs(pages))
+
+def extract_text(uploaded_file):
+    try:
+        return "\n".join(paragraph for _, paragraph in extract_paragraphs(uploaded_file)), None
+    except Exception as e: return None, str(e)
+
+# GEMINI
+GEMINI_MODEL = 'gemini-2.5-flash'
+# Set temperature to 0.0 for deterministic, consistent results
+GENERATION_CONFIG = {"temperature": 0.0}
+
+# LÍMITES DE CUOTA Y REINTENTOS
+# Token bucket compartido por todo el proceso para requests/minuto y tokens/minuto.
+# Cuando el presupuesto se agota, las llamadas esperan en cola en vez de fallar con 429.
+GEMINI_RPM_LIMIT = 1000
+GEMINI_TPM_LIMIT = 1000000
+GEMINI_VIDEO_TOKEN_ESTIMATE = 60000  # Un video no se puede medir antes de enviarlo
+GEMINI_MAX_RETRIES = 5
+GEMINI_RETRY_BASE_DELAY = 2  # Segundos; se duplica en cada intento
+GEMINI_RETRY_MAX_DELAY = 60
+
+TRANSIENT_HTTP_STATUSES = {408, 429, 500, 502, 503, 504}
+
+class GeminiRateLimiter:
+    """Token bucket doble (requests y tokens por minuto) con estadísticas para operación"""
+
+    def __init__(self, rpm_limit, tpm_limit):
+        self.rpm_limit = rpm_limit
+        self.tpm_limit = tpm_limit
+        self._requests = float(rpm_limit)
+        self._tokens = float(tpm_limit)
+        self._last_refill = time.monotonic()
+        self._condition = threading.Condition()
+        self._queue_depth = 0
+        self._throttled_seconds = 0.0
+        self._total_requests = 0
+        self._total_retries = 0
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = now - self._last_refill
+        self._last_refill = now
+        self._requests = min(self.rpm_limit, self._requests + elapsed * self.rpm_limit / 60)
+        self._tokens = min(self.tpm_limit, self._tokens + elapsed * self.tpm_limit / 60)
+
+    def acquire(self, tokens):
+        """Bloquea hasta que haya presupuesto para una request de `tokens` tokens estimados"""
+        # Una request más grande que el bucket completo nunca cabría: se limita al máximo
+        tokens = min(tokens, self.tpm_limit)
+        started = time.monotonic()
+        with self._condition:
+            self._queue_depth += 1
+            try:
+                while True:
+                    self._refill()
+                    if self._requests >= 1 and self._tokens >= tokens:
+                        self._requests -= 1
+                        self._tokens -= tokens
+                        self._total_requests += 1
+                        break
+                    wait = max(
+                        (1 - self._requests) * 60 / self.rpm_limit,
+                        (tokens - self._tokens) * 60 / self.tpm_limit
+                    )
+                    self._condition.wait(max(wait, 0.05))
+            finally:
+                self._queue_depth -= 1
+                self._throttled_seconds += time.monotonic() - started
+
+    def record_usage(self, estimated_tokens, actual_tokens):
+        """Ajusta el bucket con el consumo real que reporta Gemini"""
+        with self._condition:
+            self._tokens -= actual_tokens - min(estimated_tokens, self.tpm_limit)
+
+    def record_retry(self, delay):
+        with self._condition:
+            self._total_retries += 1
+            self._throttled_seconds += delay
+
+    def stats(self):
+        with self._condition:
+            self._refill()
+            return {
+                "queue_depth": self._queue_depth,
+                "throttled_seconds": round(self._throttled_seconds, 1),
+                "requests": self._total_requests,
+                "retries": self._total_retries,
+                "available_requests": int(self._requests),
+                "available_tokens": int(self._tokens),
+                "rpm_limit": self.rpm_limit,
+                "tpm_limit": self.tpm_limit,
+            }
+
+@process_singleton
+def get_gemini_rate_limiter():
+    return GeminiRateLimiter(
+        int(get_secret("GEMINI_RPM_LIMIT", GEMINI_RPM_LIMIT)),
+        int(get_secret("GEMINI_TPM_LIMIT", GEMINI_TPM_LIMIT))
+    )
+
+def estimate_tokens(prompt, content):
+    """Estimación barata (≈4 caracteres por token) antes de llamar a la API"""
+    if isinstance(content, str):
+        return (len(prompt) + len(content)) // 4 + 1
+    return len(prompt) // 4 + GEMINI_VIDEO_TOKEN_ESTIMATE
+
+def is_transient_error(error):
+    """Errores que vale la pena reintentar: cuota (429), 5xx, timeouts y fallas de red"""
+    from google.api_core import exceptions as google_exceptions
+    if isinstance(error, (google_exceptions.TooManyRequests, google_exceptions.ResourceExhausted,
+                          google_exceptions.ServerError, google_exceptions.DeadlineExceeded)):
+        return True
+    status = getattr(getattr(error, 'resp', None), 'status', None)
+    if status in TRANSIENT_HTTP_STATUSES:
+        return True
+    return isinstance(error, (ConnectionError, TimeoutError))
+
+def call_with_retries(fn, description="Gemini call"):
+    """Ejecuta fn() reintentando errores transitorios con backoff exponencial y jitter"""
+    limiter = get_gemini_rate_limiter()
+    for attempt in range(GEMINI_MAX_RETRIES + 1):
+        try:
+            return fn()
+        except Exception as e:
+            if attempt == GEMINI_MAX_RETRIES or not is_transient_error(e):
+                raise
+            delay = min(GEMINI_RETRY_MAX_DELAY, GEMINI_RETRY_BASE_DELAY * 2 ** attempt)
+            delay = random.uniform(delay / 2, delay)
+            print(f"⏳ {description} falló ({e}); reintento {attempt + 1}/{GEMINI_MAX_RETRIES} en {delay:.1f}s")
+            limiter.record_retry(delay)
+            time.sleep(delay)
+
+def response_schema_config(prompt):
+    """Parámetros de salida JSON restringida para los prompts con esquema declarado"""
+    schema = PROMPT_SCHEMAS.get(prompt)
+    if schema is None:
+        return {}
+    return {"response_mime_type": "application/json", "response_schema": schema}
+
+def analyze_content(prompt, content, on_risk=None, on_restart=None):
+    """Llama a Gemini; con on_risk usa streaming y llama on_risk(riesgo) en cuanto cada
+    elemento de "risks" está completo. En ambos casos devuelve la respuesta completa.
+
+    Un error transitorio a mitad del stream reintenta la llamada completa; antes de cada
+    reintento se llama on_restart() para descartar los riesgos ya reportados.
+    """
+    import google.generativeai as genai
+    api_key = get_secret("GEMINI_API_KEY")
+    genai.configure(api_key=api_key)
+    model = genai.GenerativeModel(GEMINI_MODEL)
+
+    config = genai.types.GenerationConfig(**GENERATION_CONFIG, **response_schema_config(prompt))
+
+    limiter = get_gemini_rate_limiter()
+    estimated_tokens = estimate_tokens(prompt, content)
+
+    attempts = []
+
+    def generate():
+        # Cada intento (incluidos los reintentos) cuenta contra el presupuesto
+        limiter.acquire(estimated_tokens)
+        if attempts and on_restart is not None:
+            on_restart()
+        attempts.append(None)
+        resp = model.generate_content([prompt, content], generation_config=config, stream=on_risk is not None)
+        if on_risk is not None:
+            # Consumir el stream dentro del intento: un 429/5xx a mitad de la respuesta se
+            # reintenta igual que uno al abrirla. Al terminar, resp.text tiene el texto
+            # íntegro y se parsea igual que en modo no-streaming
+            parser = StreamingRiskParser()
+            for chunk in resp:
+                try:
+                    chunk_text = chunk.text
+                except ValueError:
+                    # Chunks sin partes de texto (p.ej. solo finish_reason)
+                    continue
+                for risk in parser.feed(chunk_text):
+                    on_risk(risk)
+        return resp
+
+    resp = call_with_retries(generate, "generate_content")
+    usage = getattr(resp, "usage_metadata", None)
+    if usage and getattr(usage, "total_token_count", None):
+        limiter.record_usage(estimated_tokens, usage.total_token_count)
+    return resp
+
+# ANALYSIS CACHE
+# Resultados ya parseados en disco, indexados por hash de prompt + modelo + config + texto.
+# Un acierto evita por completo la llamada a Gemini.
+ANALYSIS_CACHE_DIR = os.path.join(".qa_cache", "analysis")
+ANALYSIS_CACHE_MAX_BYTES = 200 * 1024 * 1024  # Presupuesto total en disco
+ANALYSIS_CACHE_TTL = 7 * 24 * 3600  # Segundos
+
+def normalize_script_text(text):
+    """Normaliza el texto extraído para que diferencias de espacios no cambien la llave"""
+    lines = text.replace("\r", "").split("\n")
+    return "\n".join(line.strip() for line in lines).strip()
+
+def analysis_cache_key(prompt, text, mode="single"):
+    """Llave estable (sha256) para un análisis de texto"""
+    payload = json.dumps({
+        "prompt": prompt,
+        "model": GEMINI_MODEL,
+        "config": GENERATION_CONFIG,
+        "schema": PROMPT_SCHEMAS.get(prompt),
+        "mode": mode,
+        "content": normalize_script_text(text)
+    }, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+def load_cached_analysis(key):
+    """Devuelve el analysis_result guardado para la llave, o None si no existe o expiró"""
+    path = os.path.join(ANALYSIS_CACHE_DIR, f"{key}.json")
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            entry = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    if time.time() - entry.get("created", 0) > ANALYSIS_CACHE_TTL:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        return None
+
+    # Marcar como usado recientemente (el mtime ordena la expulsión LRU)
+    try:
+        os.utime(path, None)
+    except OSError:
+        pass
+    return entry.get("result")
+
+def save_cached_analysis(key, result):
+    """Guarda un analysis_result parseado y aplica TTL + presupuesto de tamaño"""
+    try:
+        path = os.path.join(ANALYSIS_CACHE_DIR, f"{key}.json")
+        write_json_atomic(path, {"created": time.time(), "result": result})
+        evict_analysis_cache()
+    except Exception as e:
+        print(f"⚠️ No se pudo guardar el análisis en caché: {e}")
+
+def evict_analysis_cache():
+    """Elimina entradas expiradas y luego las menos usadas hasta respetar el presupuesto"""
+    entries = []
+    now = time.time()
+    for name in os.listdir(ANALYSIS_CACHE_DIR):
+        if not name.endswith(".json"):
+            continue
+        path = os.path.join(ANALYSIS_CACHE_DIR, name)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue
+        # El mtime nunca es anterior a la creación, así que basta para detectar expirados
+        if now - stat.st_mtime > ANALYSIS_CACHE_TTL:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            continue
+        entries.append((stat.st_mtime, stat.st_size, path))
+
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= ANALYSIS_CACHE_MAX_BYTES:
+            break
+        try:
+            os.remove(path)
+            total -= size
+        except OSError:
+            pass
+
+# RESPONSE SCHEMAS
+# Gemini genera JSON restringido a estos esquemas (response_schema) y la respuesta se
+# valida con un validador "compilado" una sola vez al importar el módulo.
+def compile_schema_validator(schema):
+    """Convierte un esquema (subconjunto OpenAPI que usa Gemini) en una función validadora.
+
+    El validador devuelve el valor normalizado: convierte números que llegan como texto,
+    y completa con vacío los strings/arrays requeridos que falten (p.ej. en una respuesta
+    truncada). Lanza ValueError si el valor no se puede ajustar al esquema.
+    """
+    kind = schema["type"]
+
+    if kind == "object":
+        fields = [(name, compile_schema_validator(sub), sub["type"]) for name, sub in schema.get("properties", {}).items()]
+        required = set(schema.get("required", []))
+
+        def validate_object(value, path="$"):
+            if not isinstance(value, dict):
+                raise ValueError(f"{path}: expected object")
+            for name, validate_field, field_kind in fields:
+                if name in value:
+                    value[name] = validate_field(value[name], f"{path}.{name}")
+                elif name in required:
+                    if field_kind == "array":
+                        value[name] = []
+                    elif field_kind == "string":
+                        value[name] = ""
+                    else:
+                        raise ValueError(f"{path}.{name}: missing required field")
+            return value
+        return validate_object
+
+    if kind == "array":
+        validate_item = compile_schema_validator(schema["items"])
+
+        def validate_array(value, path="$"):
+            if not isinstance(value, list):
+                raise ValueError(f"{path}: expected array")
+            return [validate_item(item, f"{path}[{i}]") for i, item in enumerate(value)]
+        return validate_array
+
+    if kind == "number":
+        def validate_number(value, path="$"):
+            if isinstance(value, bool):
+                raise ValueError(f"{path}: expected number")
+            if isinstance(value, (int, float)):
+                return value
+            try:
+                number = float(str(value).strip())
+            except ValueError:
+                raise ValueError(f"{path}: expected number")
+            return int(number) if number.is_integer() else number
+        return validate_number
+
+    def validate_string(value, path="$"):
+        if value is None:
+            return ""
+        return value if isinstance(value, str) else str(value)
+    return validate_string
+
+def repair_truncated_json(text):
+    """Recorta un JSON truncado al último elemento completo y cierra lo que quedó abierto.
+
+    Solo se corta entre elementos de un arreglo (p.ej. "risks", "recommendations") o entre
+    pares clave-valor del objeto raíz; un riesgo a medio escribir se descarta completo en
+    lugar de quedar con campos vacíos.
+    """
+    def is_safe_cut(stack):
+        # Dentro de un arreglo, en el objeto raíz o fuera de todo contenedor
+        return len(stack) <= 1 or stack[-1] == "]"
+
+    stack = []
+    in_string = False
+    escape = False
+    safe_cut = None
+    for i, char in enumerate(text):
+        if in_string:
+            if escape:
+                escape = False
+            elif char == "\\":
+                escape = True
+            elif char == '"':
+                in_string = False
+            continue
+        if char == '"':
+            in_string = True
+        elif char in "{[":
+            stack.append("}" if char == "{" else "]")
+        elif char in "}]":
+            if stack:
+                stack.pop()
+            if is_safe_cut(stack):
+                safe_cut = (i + 1, list(stack))
+        elif char == "," and is_safe_cut(stack):
+            safe_cut = (i, list(stack))
+    if safe_cut is None:
+        raise ValueError("Response is too short to recover")
+    cut, open_containers = safe_cut
+    return text[:cut] + "".join(reversed(open_containers))
+
+def clean_json_response(text, validator=None):
+    """Parsea la respuesta JSON del LLM en una sola pasada.
+
+    Si el JSON está truncado se recupera hasta el último elemento completo (marcando
+    el resultado con "truncated": True); con validator, el resultado se valida y normaliza.
+    """
+    # Strip markdown code blocks (solo aparecen si el modelo no usó response_schema)
+    clean = text.replace("```json", "").replace("```", "").strip()
+    start = clean.find("{")
+    if start != -1:
+        clean = clean[start:]
+
+    truncated = False
+    try:
+        # Find JSON boundaries
+        result = json.loads(clean[:clean.rfind("}") + 1], strict=False)
+    except json.JSONDecodeError as original_error:
+        try:
+            result = json.loads(repair_truncated_json(clean), strict=False)
+            truncated = True
+        except ValueError:
+            raise original_error
+        print("⚠️ Respuesta JSON truncada; se recuperaron los elementos completos")
+
+    if validator is not None:
+        result = validator(result)
+    if truncated and isinstance(result, dict):
+        result["truncated"] = True
+    return result
+
+def parse_analysis(prompt, text):
+    """Parsea y valida la respuesta de Gemini con el esquema del prompt que la generó"""
+    return clean_json_response(text, PROMPT_VALIDATORS.get(prompt))
+
+class StreamingRiskParser:
+    """Parser incremental del JSON de Gemini: detecta cada elemento completo de "risks".
+
+    Solo sigue la estructura (strings, escapes y profundidad de {} / []) para saber dónde
+    empieza y termina cada riesgo; el resultado final se sigue obteniendo con
+    clean_json_response sobre el texto completo.
+    """
+
+    def __init__(self):
+        self._text = ""
+        self._pos = 0
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        self._string_start = None
+        self._last_string = None
+        self._current_key = None
+        self._risks_depth = None
+        self._element_start = None
+
+    def feed(self, chunk):
+        """Agrega texto recibido y devuelve los riesgos que se completaron con él"""
+        self._text += chunk
+        completed = []
+        text = self._text
+        for i in range(self._pos, len(text)):
+            char = text[i]
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif char == "\\":
+                    self._escape = True
+                elif char == '"':
+                    self._in_string = False
+                    if self._depth == 1:
+                        self._last_string = text[self._string_start + 1:i]
+                continue
+
+            if char == '"':
+                self._in_string = True
+                self._string_start = i
+            elif char == ":" and self._depth == 1:
+                self._current_key = self._last_string
+            elif char == "," and self._depth == 1:
+                self._current_key = None
+            elif char in "{[":
+                if char == "[" and self._depth == 1 and self._current_key == "risks":
+                    self._risks_depth = 2
+                elif char == "{" and self._risks_depth is not None and self._depth == self._risks_depth:
+                    self._element_start = i
+                self._depth += 1
+            elif char in "}]":
+                self._depth -= 1
+                if char == "}" and self._element_start is not None and self._depth == self._risks_depth:
+                    try:
+                        completed.append(json.loads(text[self._element_start:i + 1], strict=False))
+                    except json.JSONDecodeError:
+                        pass
+                    self._element_start = None
+                elif char == "]" and self._risks_depth is not None and self._depth == self._risks_depth - 1:
+                    self._risks_depth = None
+        self._pos = len(text)
+        return completed
+
+# WINDOWED ANALYSIS
+# Modo opcional para guiones largos: el texto se parte en ventanas de párrafos que se
+# traslapan, cada ventana se analiza en paralelo y los resultados se combinan.
+ANALYSIS_WINDOW_CHARS = 12000  # Tamaño objetivo de cada ventana
+# Máximo de caracteres compartidos entre ventanas consecutivas (párrafos completos; un
+# párrafo más largo que esto no se repite)
+ANALYSIS_WINDOW_OVERLAP = 1500
+ANALYSIS_WINDOW_WORKERS = 4
+
+def split_paragraph_windows(text, window_chars=ANALYSIS_WINDOW_CHARS, overlap=ANALYSIS_WINDOW_OVERLAP):
+    """Divide la salida de reconstruct_paragraphs en ventanas traslapadas de párrafos completos"""
+    paragraphs = text.split("\n")
+    windows = []
+    start = 0
+    while start < len(paragraphs):
+        end = start
+        size = 0
+        # Siempre al menos un párrafo, aunque por sí solo supere el tamaño de ventana
+        while end < len(paragraphs) and (end == start or size + len(paragraphs[end]) <= window_chars):
+            size += len(paragraphs[end]) + 1
+            end += 1
+        windows.append("\n".join(paragraphs[start:end]))
+        if end >= len(paragraphs):
+            break
+        # Retroceder por los últimos párrafos mientras quepan en el traslape
+        next_start = end
+        shared = 0
+        while next_start - 1 > start and shared + len(paragraphs[next_start - 1]) + 1 <= overlap:
+            next_start -= 1
+            shared += len(paragraphs[next_start]) + 1
+        start = next_start
+    return windows
+
+def _dedupe_key(value):
+    return " ".join(str(value).lower().split())
+
+def merge_window_results(results):
+    """Combina los análisis por ventana de forma determinista (mismo orden, mismo resultado).
+
+    - score: el mínimo, porque la ventana con más incumplimientos define el guion.
+    - risks: en orden de ventana, sin repetir la misma cita (la ventana traslapada la ve dos veces).
+    - recommendations: unión en orden de aparición, sin duplicados.
+    - email_draft: el de la ventana con peor score (la primera en caso de empate).
+    """
+    merged = {"score": 100, "risks": [], "recommendations": [], "email_draft": ""}
+    seen_quotes = set()
+    seen_recs = set()
+    worst_score = None
+
+    for result in results:
+        try:
+            score = float(result.get("score", 100))
+        except (TypeError, ValueError):
+            score = 100
+        if worst_score is None or score < worst_score:
+            worst_score = score
+            merged["email_draft"] = result.get("email_draft", "")
+
+        for risk in result.get("risks", []):
+            quote_key = _dedupe_key(risk.get("quote", "")) or _dedupe_key(risk.get("risk", ""))
+            if quote_key in seen_quotes:
+                continue
+            seen_quotes.add(quote_key)
+            merged["risks"].append(risk)
+
+        for rec in result.get("recommendations", []):
+            rec_key = _dedupe_key(rec)
+            if rec_key in seen_recs:
+                continue
+            seen_recs.add(rec_key)
+            merged["recommendations"].append(rec)
+
+    if any(result.get("truncated") for result in results):
+        merged["truncated"] = True
+    if worst_score is not None:
+        merged["score"] = int(worst_score) if worst_score == int(worst_score) else worst_score
+    return merged
+
+def analyze_windowed(prompt, text, max_workers=ANALYSIS_WINDOW_WORKERS):
+    """Analiza un guion largo por ventanas en paralelo y devuelve el resultado ya combinado"""
+    windows = split_paragraph_windows(text)
+    print(f"DEBUG: Windowed analysis over {len(windows)} window(s)")
+
+    def analyze_window(window):
+        resp = analyze_content(prompt, window)
+        return parse_analysis(prompt, resp.text)
+
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(windows)), thread_name_prefix="analysis-window") as executor:
+        results = list(executor.map(analyze_window, windows))
+    return merge_window_results(results)
+
+# SCRIPT ANALYSIS
+def analyze_script(uploaded_file, windowed=False, on_risk=None, on_restart=None):
+    """Extrae el texto de un guion y lo analiza (usando la caché de análisis).
+
+    Devuelve (analysis_result, error, raw_response); analysis_result es None si algo falló.
+    Con on_risk (solo modo de una request) los riesgos se reportan mientras llegan;
+    on_restart() avisa que un reintento descartó los reportados hasta ese momento.
+    Es seguro llamarla desde varios hilos a la vez (no toca st.session_state).
+    """
+    txt, err = extract_text(uploaded_file)
+    if not txt:
+        return None, f"Could not extract text from {uploaded_file.name}: {err or 'empty file'}", None
+
+    # Clean text for better matching
+    txt = txt.replace("\r", "")
+    analysis_mode = f"windowed:{ANALYSIS_WINDOW_CHARS}:{ANALYSIS_WINDOW_OVERLAP}" if windowed else "single"
+    cache_key = analysis_cache_key(PROMPT_F1, txt, analysis_mode)
+    cached_result = load_cached_analysis(cache_key)
+    if cached_result is not None:
+        print(f"DEBUG: Analysis cache hit ({cache_key[:12]})")
+        return cached_result, None, None
+
+    if windowed:
+        try:
+            result = analyze_windowed(PROMPT_F1, txt)
+        except Exception as e:
+            print(f"DEBUG: Windowed Analysis Error: {e}")
+            return None, f"Error interpreting AI response: {e}", None
+    else:
+        try:
+            resp = analyze_content(PROMPT_F1, txt, on_risk=on_risk, on_restart=on_restart)
+            raw_text = resp.text
+        except Exception as e:
+            # Errores de la API que no se reintentan, reintentos agotados o respuesta bloqueada
+            print(f"DEBUG: Gemini Error: {e}")
+            return None, f"Error calling Gemini: {e}", None
+        print(f"DEBUG: Raw AI Response (Text): {raw_text}")
+        try:
+            result = parse_analysis(PROMPT_F1, raw_text)
+        except Exception as e:
+            print(f"DEBUG: Parsing Error: {e}")
+            return None, f"Error interpreting AI response: {e}", raw_text
+
+    # Un análisis truncado es parcial: no se guarda para que el siguiente intento lo rehaga
+    if not result.get("truncated"):
+        save_cached_analysis(cache_key, result)
+    return result, None, None
+
+# VIDEO JOBS
+# Las auditorías de video corren fuera del hilo del script de Streamlit: un pool de
+# workers sube el archivo y genera el análisis, y un único hilo sondea el estado de
+# procesamiento de todos los videos, así ningún worker se queda dormido esperando.
+VIDEO_JOB_WORKERS = 4
+VIDEO_JOB_POLL_INTERVAL = 5  # Segundos entre sondeos a Gemini
+VIDEO_JOB_RETENTION = 3600  # Segundos que se conserva un job terminado
+
+VIDEO_JOB_PROGRESS = {
+    "queued": (0.05, "Waiting for a free worker..."),
+    "uploading": (0.2, "Uploading video to Gemini..."),
+    "processing": (0.5, "Gemini is processing the video..."),
+    "analyzing": (0.8, "Analyzing video with Gemini AI..."),
+    "done": (1.0, "Analysis completed"),
+    "failed": (1.0, "Analysis failed"),
+}
+
+# Spool de videos: cada subida se copia por bloques a un archivo propio del job, con un
+# tope de disco reservado antes de escribir. El archivo se borra en cuanto Gemini lo recibe.
+VIDEO_SPOOL_DIR = os.path.join(".qa_cache", "spool")
+VIDEO_SPOOL_MAX_BYTES = 4 * 1024 * 1024 * 1024
+VIDEO_SPOOL_CHUNK_SIZE = 8 * 1024 * 1024
+# Spools de otros procesos con más antigüedad que esto se consideran huérfanos aunque su
+# pid siga vivo (el pid pudo reutilizarse después de un reinicio)
+VIDEO_SPOOL_STALE_AGE = 48 * 3600
+
+def is_process_alive(pid):
+    """True si existe un proceso con ese pid en esta máquina"""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        # Existe pero pertenece a otro usuario
+        return True
+    return True
+
+class SpoolFullError(Exception):
+    """No hay espacio reservado suficiente en el spool para otro video"""
+
+class VideoSpool:
+    """Archivos temporales de video con nombre único y uso de disco acotado"""
+
+    def __init__(self, directory=VIDEO_SPOOL_DIR, max_bytes=VIDEO_SPOOL_MAX_BYTES):
+        # Cada proceso (la app, qa_batch.py) usa su propio subdirectorio para no borrar
+        # archivos que otro proceso todavía está subiendo
+        self.root = directory
+        self.directory = os.path.join(directory, str(os.getpid()))
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._reserved = {}
+        self._remove_orphans()
+        os.makedirs(self.directory, exist_ok=True)
+
+    def _remove_orphans(self):
+        """Borra los spools de procesos que ya terminaron (o demasiado viejos)"""
+        try:
+            entries = list(os.scandir(self.root))
+        except OSError:
+            return
+        for entry in entries:
+            if not entry.is_dir() or not entry.name.isdigit():
+                continue
+            pid = int(entry.name)
+            try:
+                stale = time.time() - entry.stat().st_mtime > VIDEO_SPOOL_STALE_AGE
+            except OSError:
+                continue
+            if pid == os.getpid() or not is_process_alive(pid) or stale:
+                shutil.rmtree(entry.path, ignore_errors=True)
+
+    def usage(self):
+        with self._lock:
+            return sum(self._reserved.values())
+
+    def write(self, uploaded_file):
+        """Copia el archivo subido por bloques a un spool propio.
+
+        Devuelve (ruta, sha256 del contenido); el hash se calcula en la misma pasada.
+        """
+        size = getattr(uploaded_file, "size", None)
+        if size is None:
+            # Archivo abierto desde disco (CLI) en lugar de un UploadedFile de Streamlit
+            size = os.fstat(uploaded_file.fileno()).st_size
+        extension = os.path.splitext(uploaded_file.name)[1].lower() or ".mp4"
+        path = os.path.join(self.directory, f"{uuid.uuid4().hex}{extension}")
+        with self._lock:
+            if sum(self._reserved.values()) + size > self.max_bytes:
+                raise SpoolFullError("The server is processing too many videos right now. Please try again in a few minutes.")
+            self._reserved[path] = size
+        digest = hashlib.sha256()
+        try:
+            uploaded_file.seek(0)
+            with open(path, "wb") as f:
+                while True:
+                    chunk = uploaded_file.read(VIDEO_SPOOL_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    digest.update(chunk)
+                    f.write(chunk)
+        except Exception:
+            self.release(path)
+            raise
+        return path, digest.hexdigest()
+
+    def release(self, path):
+        """Borra el archivo del spool y libera su reserva"""
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        with self._lock:
+            self._reserved.pop(path, None)
+
+@process_singleton
+def get_video_spool():
+    return VideoSpool()
+
+# Registro de archivos en la Files API de Gemini, por hash de contenido. Un video que ya
+# está ACTIVE en Gemini se reutiliza sin volver a subirlo ni esperar el procesamiento.
+GEMINI_FILE_REGISTRY_PATH = os.path.join(".qa_cache", "gemini_files.json")
+GEMINI_FILE_EXPIRY_MARGIN = 3600  # No reutilizar archivos que expiran en menos de esto
+GEMINI_FILE_IDLE_TTL = 24 * 3600  # Borrar archivos sin uso tras este tiempo
+GEMINI_FILE_GC_INTERVAL = 600  # Segundos entre pasadas del recolector
+
+class GeminiFileRegistry:
+    """Mapa persistente sha256 -> archivo subido a Gemini (nombre, estado, expiración)"""
+
+    def __init__(self, path=GEMINI_FILE_REGISTRY_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                self._entries = json.load(f)
+        except (OSError, ValueError):
+            self._entries = {}
+
+    def lookup(self, content_hash):
+        """Nombre del archivo si sigue ACTIVE y no está por expirar; None en otro caso"""
+        with self._lock:
+            entry = self._entries.get(content_hash)
+            if not entry or entry["state"] != "ACTIVE":
+                return None
+            if entry["expires"] - time.time() < GEMINI_FILE_EXPIRY_MARGIN:
+                return None
+            entry["last_used"] = time.time()
+            self._save()
+            return entry["name"]
+
+    def register(self, content_hash, gemini_file):
+        """Registra un archivo ACTIVE; devuelve False si ya hay otro válido para el mismo hash"""
+        with self._lock:
+            current = self._entries.get(content_hash)
+            if current and current["name"] != gemini_file.name and current["expires"] - time.time() >= GEMINI_FILE_EXPIRY_MARGIN:
+                return False
+            expiration = getattr(gemini_file, "expiration_time", None)
+            self._entries[content_hash] = {
+                "name": gemini_file.name,
+                "state": gemini_file.state.name,
+                "expires": expiration.timestamp() if expiration else time.time() + GEMINI_FILE_IDLE_TTL,
+                "last_used": time.time(),
+            }
+            self._save()
+            return True
+
+    def is_registered(self, gemini_name):
+        with self._lock:
+            return any(entry["name"] == gemini_name for entry in self._entries.values())
+
+    def discard(self, content_hash):
+        with self._lock:
+            if self._entries.pop(content_hash, None) is not None:
+                self._save()
+
+    def collect_garbage(self):
+        """Olvida archivos expirados y borra de Gemini los que llevan mucho sin usarse"""
+        now = time.time()
+        with self._lock:
+            expired = [h for h, e in self._entries.items() if e["expires"] <= now]
+            idle = [(h, e["name"]) for h, e in self._entries.items() if e["expires"] > now and now - e["last_used"] > GEMINI_FILE_IDLE_TTL]
+            for content_hash in expired:
+                del self._entries[content_hash]
+            if expired:
+                self._save()
+        for content_hash, name in idle:
+            delete_gemini_file(name)
+            self.discard(content_hash)
+
+    def _save(self):
+        try:
+            write_json_atomic(self.path, self._entries)
+        except Exception as e:
+            print(f"⚠️ No se pudo guardar el registro de archivos de Gemini: {e}")
+
+@process_singleton
+def get_gemini_file_registry():
+    return GeminiFileRegistry()
+
+def delete_gemini_file(name):
+    import google.generativeai as genai
+    try:
+        genai.delete_file(name)
+        print(f"🗑️ Archivo de Gemini eliminado: {name}")
+    except Exception as e:
+        print(f"⚠️ No se pudo eliminar el archivo de Gemini {name}: {e}")
+
+class VideoJobEngine:
+    """Motor de jobs de auditoría de video compartido por todas las sesiones"""
+
+    def __init__(self, spool, registry, max_workers=VIDEO_JOB_WORKERS, poll_interval=VIDEO_JOB_POLL_INTERVAL):
+        self._spool = spool
+        self._registry = registry
+        self._last_gc = 0
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="video-job")
+        self._poll_interval = poll_interval
+        self._lock = threading.Lock()
+        self._jobs = {}
+        self._wakeup = threading.Event()
+        self._poller = threading.Thread(target=self._poll_loop, name="video-job-poller", daemon=True)
+        self._poller.start()
+
+    def submit(self, video_path, content_hash, prompt):
+        """Encola la auditoría de un video ya guardado en el spool y devuelve el ID del job"""
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        with self._lock:
+            self._prune(now)
+            self._jobs[job_id] = {
+                "id": job_id,
+                "state": "queued",
+                "video_path": video_path,
+                "content_hash": content_hash,
+                "prompt": prompt,
+                "gemini_file": None,
+                "result": None,
+                "partial_risks": [],
+                "raw_response": None,
+                "error": None,
+                "created": now,
+                "updated": now,
+            }
+        self._executor.submit(self._upload, job_id)
+        return job_id
+
+    def get(self, job_id):
+        """Copia del estado actual del job (None si no existe o ya se descartó)"""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return None
+            snapshot = {k: v for k, v in job.items() if k != "gemini_file"}
+            snapshot["partial_risks"] = list(job["partial_risks"])
+        snapshot["progress"], snapshot["message"] = VIDEO_JOB_PROGRESS[snapshot["state"]]
+        return snapshot
+
+    def _update(self, job_id, **changes):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is not None:
+                job.update(changes, updated=time.time())
+            return job
+
+    def _fail(self, job_id, error, raw_response=None):
+        print(f"❌ Video job {job_id} falló: {error}")
+        self._update(job_id, state="failed", error=str(error), raw_response=raw_response)
+
+    def _prune(self, now):
+        expired = [
+            job_id for job_id, job in self._jobs.items()
+            if job["state"] in ("done", "failed") and now - job["updated"] > VIDEO_JOB_RETENTION
+        ]
+        for job_id in expired:
+            del self._jobs[job_id]
+
+    def _upload(self, job_id):
+        job = self._update(job_id, state="uploading")
+        if self._reuse_registered_file(job_id, job):
+            return
+        import google.generativeai as genai
+        try:
+            gemini_file = call_with_retries(lambda: genai.upload_file(job["video_path"]), "upload_file")
+        except Exception as e:
+            self._fail(job_id, e)
+            return
+        finally:
+            self._spool.release(job["video_path"])
+        self._update(job_id, state="processing", gemini_file=gemini_file)
+        self._wakeup.set()
+
+    def _reuse_registered_file(self, job_id, job):
+        """Salta la subida y el sondeo si el mismo video ya está ACTIVE en Gemini"""
+        name = self._registry.lookup(job["content_hash"])
+        if not name:
+            return False
+        import google.generativeai as genai
+        try:
+            gemini_file = genai.get_file(name)
+        except Exception as e:
+            print(f"⚠️ Archivo registrado no disponible ({name}): {e}")
+            gemini_file = None
+        if gemini_file is None or gemini_file.state.name != "ACTIVE":
+            self._registry.discard(job["content_hash"])
+            return False
+        print(f"♻️ Reutilizando video ya subido a Gemini: {name}")
+        self._spool.release(job["video_path"])
+        self._update(job_id, state="analyzing", gemini_file=gemini_file)
+        self._executor.submit(self._analyze, job_id)
+        return True
+
+    def _poll_loop(self):
+        import google.generativeai as genai
+        while True:
+            self._wakeup.wait(self._poll_interval)
+            self._wakeup.clear()
+            if time.time() - self._last_gc > GEMINI_FILE_GC_INTERVAL:
+                self._last_gc = time.time()
+                try:
+                    self._registry.collect_garbage()
+                except Exception as e:
+                    print(f"⚠️ Error en la recolección de archivos de Gemini: {e}")
+            with self._lock:
+                pending = [(job_id, job["gemini_file"]) for job_id, job in self._jobs.items() if job["state"] == "processing"]
+            for job_id, gemini_file in pending:
+                try:
+                    if gemini_file.state.name == "PROCESSING":
+                        gemini_file = genai.get_file(gemini_file.name)
+                except Exception as e:
+                    # Un error transitorio solo pospone el sondeo a la siguiente vuelta
+                    if not is_transient_error(e):
+                        self._fail(job_id, e)
+                    continue
+                state = gemini_file.state.name
+                if state == "PROCESSING":
+                    self._update(job_id, gemini_file=gemini_file)
+                elif state == "FAILED":
+                    self._fail(job_id, "Video processing failed on Gemini.")
+                    delete_gemini_file(gemini_file.name)
+                else:
+                    with self._lock:
+                        content_hash = self._jobs[job_id]["content_hash"]
+                    self._registry.register(content_hash, gemini_file)
+                    self._update(job_id, state="analyzing", gemini_file=gemini_file)
+                    self._executor.submit(self._analyze, job_id)
+
+    def _analyze(self, job_id):
+        with self._lock:
+            job = self._jobs[job_id]
+            prompt, gemini_file = job["prompt"], job["gemini_file"]
+        def add_partial_risk(risk):
+            with self._lock:
+                self._jobs[job_id]["partial_risks"].append(risk)
+        def clear_partial_risks():
+            with self._lock:
+                self._jobs[job_id]["partial_risks"] = []
+
+        try:
+            resp = analyze_content(prompt, gemini_file, on_risk=add_partial_risk, on_restart=clear_partial_risks)
+        except Exception as e:
+            self._fail(job_id, e)
+            return
+        finally:
+            # Si otro job ya registró el mismo contenido, esta copia sobra
+            if not self._registry.is_registered(gemini_file.name):
+                delete_gemini_file(gemini_file.name)
+        print(f"DEBUG: Raw AI Response (Video): {resp.text}")
+        try:
+            result = parse_analysis(prompt, resp.text)
+        except Exception as e:
+            print(f"DEBUG: Parsing Error: {e}")
+            self._fail(job_id, f"Error interpreting AI response: {e}", raw_response=resp.text)
+            return
+        self._update(job_id, state="done", result=result, raw_response=resp.text)
+
+@process_singleton
+def get_video_job_engine():
+    """Motor único por proceso: los jobs siguen corriendo aunque el navegador se desconecte"""
+    return VideoJobEngine(get_video_spool(), get_gemini_file_registry())
+
+# DATABASE
+SHEET_HEADERS = ["Timestamp", "Brand", "Campaign", "Influencer", "Version", "Score", "Recommendations", "Drive Folder Link", "Original File Link", "Report Link"]
+SCORE_COLUMN_INDEX = 5  # Columna F (Score), base 0
+
+# Hojas cuyo encabezado y formato ya se verificaron en este proceso
+_verified_sheets = set()
+_verified_sheets_lock = threading.Lock()
+
+def score_format_requests(sheet_id):
+    """Reglas de formato condicional del Score (rojo < 60, naranja < 90, verde el resto).
+
+    Al vivir en la hoja, cada registro nuevo se colorea solo y no necesita su propio request.
+    El rango no tiene fila final y Sheets trata las celdas vacías como 0, así que cada
+    fórmula exige que la celda tenga un número.
+    """
+    score_range = {"sheetId": sheet_id, "startRowIndex": 1, "startColumnIndex": SCORE_COLUMN_INDEX, "endColumnIndex": SCORE_COLUMN_INDEX + 1}
+    # Fórmulas relativas a la primera celda del rango (F2)
+    cell = f"{chr(ord('A') + SCORE_COLUMN_INDEX)}2"
+    rules = [
+        (f"=AND(ISNUMBER({cell}),{cell}<60)", {"red": 0.95, "green": 0.3, "blue": 0.3}),  # Rojo
+        (f"=AND(ISNUMBER({cell}),{cell}<90)", {"red": 1.0, "green": 0.8, "blue": 0.4}),  # Amarillo/Naranja
+        (f"=AND(ISNUMBER({cell}),{cell}>=90)", {"red": 0.3, "green": 0.7, "blue": 0.3}),  # Verde
+    ]
+    return [
+        {
+            "addConditionalFormatRule": {
+                "rule": {
+                    "ranges": [score_range],
+                    "booleanRule": {
+                        "condition": {"type": "CUSTOM_FORMULA", "values": [{"userEnteredValue": formula}]},
+                        "format": {"backgroundColor": color, "textFormat": {"bold": True}}
+                    }
+                },
+                "index": index
+            }
+        }
+        for index, (formula, color) in enumerate(rules)
+    ] + [
+        {
+            "repeatCell": {
+                "range": score_range,
+                "cell": {"userEnteredFormat": {"horizontalAlignment": "CENTER"}},
+                "fields": "userEnteredFormat(horizontalAlignment)"
+            }
+        }
+    ]
+
+def score_format_update_requests(spreadsheet, sheet_id):
+    """Requests para dejar al día el formato condicional del Score ([] si ya lo está).
+
+    Las reglas NUMBER_LESS de versiones anteriores pintaban de rojo las celdas vacías debajo
+    de los datos; se borran y se agregan las de score_format_requests.
+    """
+    metadata = spreadsheet.fetch_sheet_metadata(
+        params={"fields": "sheets(properties.sheetId,conditionalFormats(ranges,booleanRule.condition.type))"}
+    )
+    score_rules = []
+    for sheet_metadata in metadata.get("sheets", []):
+        if sheet_metadata["properties"]["sheetId"] != sheet_id:
+            continue
+        for index, rule in enumerate(sheet_metadata.get("conditionalFormats", [])):
+            if any(r.get("startColumnIndex") == SCORE_COLUMN_INDEX for r in rule.get("ranges", [])):
+                score_rules.append((index, rule.get("booleanRule", {}).get("condition", {}).get("type")))
+    if score_rules and all(condition == "CUSTOM_FORMULA" for _, condition in score_rules):
+        return []
+    # De atrás hacia adelante para que los índices restantes no se muevan
+    deletes = [
+        {"deleteConditionalFormatRule": {"sheetId": sheet_id, "index": index}}
+        for index, _ in reversed(score_rules)
+    ]
+    return deletes + score_format_requests(sheet_id)
+
+def initialize_sheet_headers(sheet):
+    """Inicializa los encabezados y el formato del Score si no existen.
+
+    Devuelve True si la hoja quedó verificada.
+    """
+    try:
+        # Verificar si la primera fila está vacía o no tiene encabezados
+        first_row = sheet.row_values(1)
+        expected_headers = SHEET_HEADERS
+        
+        if not first_row or first_row != expected_headers:
+            if first_row and first_row[0] not in ["Timestamp", "TS"]:
+                sheet.clear()
+            
+            # Agregar encabezados
+            sheet.append_row(expected_headers)
+            
+            # Intentar formatear encabezados usando la API de Sheets directamente
+            try:
+                spreadsheet = sheet.spreadsheet
+                # Obtener el ID de la hoja (gspread expone sheet.id)
+                sheet_id = sheet.id
+                
+                requests = [
+                    {
+                        "updateDimensionProperties": {
+                            "range": {
+                                "sheetId": sheet_id,
+                                "dimension": "COLUMNS",
+                                "startIndex": 0,
+                                "endIndex": 1
+                            },
+                            "properties": {"pixelSize": 150},
+                            "fields": "pixelSize"
+                        }
+                    },
+                    {
+                        "updateDimensionProperties": {
+                            "range": {
+                                "sheetId": sheet_id,
+                                "dimension": "COLUMNS",
+                                "startIndex": 1,
+                                "endIndex": 2
+                            },
+                            "properties": {"pixelSize": 100},
+                            "fields": "pixelSize"
+                        }
+                    },
+                    {
+                        "updateDimensionProperties": {
+                            "range": {
+                                "sheetId": sheet_id,
+                                "dimension": "COLUMNS",
+                                "startIndex": 2,
+                                "endIndex": 3
+                            },
+                            "properties": {"pixelSize": 200},
+                            "fields": "pixelSize"
+                        }
+                    },
+                    {
+                        "updateDimensionProperties": {
+                            "range": {
+                                "sheetId": sheet_id,
+                                "dimension": "COLUMNS",
+                                "startIndex": 3,
+                                "endIndex": 4
+                            },
+                            "properties": {"pixelSize": 150},
+                            "fields": "pixelSize"
+                        }
+                    },
+                    {
+                        "updateDimensionProperties": {
+                            "range": {
+                                "sheetId": sheet_id,
+                                "dimension": "COLUMNS",
+                                "startIndex": 4,
+                                "endIndex": 5
+                            },
+                            "properties": {"pixelSize": 150},
+                            "fields": "pixelSize"
+                        }
+                    },
+                    {
+                        "updateDimensionProperties": {
+                            "range": {
+                                "sheetId": sheet_id,
+                                "dimension": "COLUMNS",
+                                "startIndex": 5,
+                                "endIndex": 6
+                            },
+                            "properties": {"pixelSize": 80},
+                            "fields": "pixelSize"
+                        }
+                    },
+                    {
+                        "updateDimensionProperties": {
+                            "range": {
+                                "sheetId": sheet_id,
+                                "dimension": "COLUMNS",
+                                "startIndex": 6,
+                                "endIndex": 7
+                            },
+                            "properties": {"pixelSize": 300},
+                            "fields": "pixelSize"
+                        }
+                    },
+                    {
+                        "updateDimensionProperties": {
+                            "range": {
+                                "sheetId": sheet_id,
+                                "dimension": "COLUMNS",
+                                "startIndex": 7,
+                                "endIndex": 10
+                            },
+                            "properties": {"pixelSize": 200},
+                            "fields": "pixelSize"
+                        }
+                    },
+                    {
+                        "repeatCell": {
+                            "range": {
+                                "sheetId": sheet_id,
+                                "startRowIndex": 0,
+                                "endRowIndex": 1,
+                                "startColumnIndex": 0,
+                                "endColumnIndex": len(expected_headers)
+                            },
+                            "cell": {
+                                "userEnteredFormat": {
+                                    "backgroundColor": {"red": 0.0, "green": 0.24, "blue": 0.18},
+                                    "textFormat": {
+                                        "foregroundColor": {"red": 1.0, "green": 1.0, "blue": 1.0},
+                                        "bold": True,
+                                        "fontSize": 11
+                                    },
+                                    "horizontalAlignment": "CENTER"
+                                }
+                            },
+                            "fields": "userEnteredFormat(backgroundColor,textFormat,horizontalAlignment)"
+                        }
+                    }
+                ]
+                
+                spreadsheet.batch_update({"requests": requests})
+            except Exception as format_error:
+                # Si falla el formato avanzado, al menos los encabezados estarán ahí
+                print(f"Nota: No se pudo aplicar formato avanzado a los encabezados: {format_error}")
+        
+        # Formato condicional del Score (hojas sin reglas o con las reglas NUMBER_LESS anteriores)
+        try:
+            format_requests = score_format_update_requests(sheet.spreadsheet, sheet.id)
+            if format_requests:
+                sheet.spreadsheet.batch_update({"requests": format_requests})
+        except Exception as format_error:
+            print(f"Nota: No se pudo aplicar formato de color al score: {format_error}")
+        return True
+            
+    except Exception as e:
+        print(f"Error inicializando encabezados: {e}")
+        return False
+
+def ensure_sheet_headers(sheet):
+    """initialize_sheet_headers una sola vez por hoja y por proceso"""
+    key = (sheet.spreadsheet.id, sheet.id)
+    if key in _verified_sheets:
+        return
+    with _verified_sheets_lock:
+        if key not in _verified_sheets and initialize_sheet_headers(sheet):
+            _verified_sheets.add(key)
+
+def save_db_record(record, drive_links):
+    """Guarda registro en Sheets con encabezados y links formateados"""
+    sheet_id = get_secret("GOOGLE_SHEET_ID")
+    if GOOGLE_SERVICES_AVAILABLE and sheet_id and os.path.exists("credentials.json"):
+        try:
+            client = get_google_clients().gspread_client()
+            sheet = client.open_by_key(sheet_id).sheet1
+            
+            # Inicializar encabezados si es necesario (verificado una vez por proceso)
+            ensure_sheet_headers(sheet)
+            
+            # Preparar datos de la fila - asegurar que todos sean strings válidos
+            def clean_value(value):
+                """Limpia un valor para que sea válido en Sheets"""
+                if value is None:
+                    return ""
+                if isinstance(value, (int, float)):
+                    return value
+                # Convertir a string y limpiar caracteres problemáticos
+                value_str = str(value)
+                # Reemplazar saltos de línea con espacios para evitar problemas
+                value_str = value_str.replace('\n', ' ').replace('\r', ' ')
+                # Limitar longitud para evitar problemas (Sheets tiene límite de 50,000 caracteres por celda)
+                if len(value_str) > 50000:
+                    value_str = value_str[:50000] + "... [truncated]"
+                return value_str
+            
+            # Cada celda lleva su tipo explícito: Sheets no interpreta los textos (fechas,
+            # ceros a la izquierda, "3/4", "- Cambiar...", "=...") y solo los links son fórmulas
+            def text_cell(value):
+                return {"userEnteredValue": {"stringValue": str(clean_value(value))}}
+            
+            def number_cell(value):
+                return {"userEnteredValue": {"numberValue": value}}
+            
+            timestamp = text_cell(record.get("TS", datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
+            brand = text_cell(record.get("Brand", ""))
+            campaign = text_cell(record.get("Camp", ""))
+            influencer = text_cell(record.get("Inf", ""))
+            version = text_cell(record.get("Ver", ""))
+            score = record.get("Score", 0)
+            # Asegurar que score sea un número
+            try:
+                score = float(score) if score else 0
+            except (ValueError, TypeError):
+                score = 0
+            recs = text_cell(record.get("Recs", ""))
+            
+            # Extraer links de Drive (el primero es la carpeta, luego archivos)
+            folder_link = clean_value(drive_links[0] if len(drive_links) > 0 else "")
+            file_link = clean_value(drive_links[1] if len(drive_links) > 1 else "")
+            report_link = clean_value(drive_links[2] if len(drive_links) > 2 else "")
+            
+            # Formatear links como hipervínculos usando fórmulas HYPERLINK
+            # Escapar comillas dobles en los links para evitar errores
+            def hyperlink(link, label):
+                """Celda con fórmula HYPERLINK (las comillas del link escapadas)"""
+                if not link or not link.strip():
+                    return text_cell("")
+                safe_link = link.replace('"', '""')  # Escapar comillas dobles
+                return {"userEnteredValue": {"formulaValue": f'=HYPERLINK("{safe_link}", "{label}")'}}
+            
+            # Fila completa (datos + fórmulas) en un solo appendCells; el color del Score lo
+            # pone el formato condicional de la hoja
+            row_data = [
+                timestamp,
+                brand,
+                campaign,
+                influencer,
+                version,
+                number_cell(score),
+                recs,
+                hyperlink(folder_link, "📁 Open Folder"),
+                hyperlink(file_link, "📄 View File"),
+                hyperlink(report_link, "📊 View Report")
+            ]
+            
+            sheet.spreadsheet.batch_update({"requests": [{
+                "appendCells": {
+                    "sheetId": sheet.id,
+                    "rows": [{"values": row_data}],
+                    "fields": "userEnteredValue"
+                }
+            }]})
+            print(f"✅ Registro guardado en Sheets: {record.get('Camp', '')} / {record.get('Inf', '')} / {record.get('Ver', '')}")
+            
+            return True
+            
+        except Exception as e:
+            notify("error", f"❌ Error saving to Sheets: {str(e)}")
+            print(f"Sheets Save Error: {e}")
+            return False
+    return False
+
+
+# BASE LOCAL (SQLITE)
+QA_DB_PATH = os.path.join(".qa_cache", "qa_store.sqlite3")
+
+@contextlib.contextmanager
+def connect_qa_db(path=QA_DB_PATH):
+    """Conexión nueva a la base local (una por operación: sqlite3 no se comparte entre hilos).
+
+    Hace commit al salir sin error y siempre cierra la conexión.
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    conn = sqlite3.connect(path, timeout=30)
+    conn.row_factory = sqlite3.Row
+    try:
+        conn.execute("PRAGMA journal_mode=WAL")
+        with conn:
+            yield conn
+    finally:
+        conn.close()
+
+# REVIEW STORE
+# Fuente de verdad de las revisiones: cada envío se guarda aquí al instante (con los riesgos
+# y recomendaciones completos) y Sheets queda como espejo que el outbox actualiza después.
+REVIEW_FILTERS = ("brand", "campaign", "influencer", "version")
+
+class ReviewStore:
+    """Revisiones guardadas en SQLite con índices para las consultas por marca/campaña/etc."""
+
+    def __init__(self, path):
+        self._path = path
+        with connect_qa_db(self._path) as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS reviews (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    ts TEXT NOT NULL,
+                    brand TEXT NOT NULL,
+                    campaign TEXT NOT NULL,
+                    influencer TEXT NOT NULL,
+                    version TEXT NOT NULL,
+                    score REAL,
+                    recs TEXT,
+                    content_type TEXT,
+                    file_name TEXT,
+                    reviewer TEXT,
+                    risks_json TEXT NOT NULL DEFAULT '[]',
+                    recommendations_json TEXT NOT NULL DEFAULT '[]',
+                    drive_links TEXT NOT NULL DEFAULT '[]',
+                    mirror_job INTEGER
+                )
+            """)
+            for column in REVIEW_FILTERS + ("ts",):
+                conn.execute(f"CREATE INDEX IF NOT EXISTS reviews_{column} ON reviews ({column})")
+            # "Todos los V1 de este influencer", ordenados por fecha
+            conn.execute("CREATE INDEX IF NOT EXISTS reviews_influencer_version_ts ON reviews (influencer, version, ts)")
+
+    def add(self, record, risks, recommendations, content_type=None, file_name=None, reviewer=None):
+        """Guarda la revisión (`record` con las llaves de save_db_record); devuelve el id"""
+        with connect_qa_db(self._path) as conn:
+            cursor = conn.execute(
+                "INSERT INTO reviews (ts, brand, campaign, influencer, version, score, recs, content_type, "
+                "file_name, reviewer, risks_json, recommendations_json) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (record["TS"], record["Brand"], record["Camp"], record["Inf"], record["Ver"], record.get("Score"),
+                 record.get("Recs", ""), content_type, file_name, reviewer,
+                 json.dumps(risks, ensure_ascii=False), json.dumps(recommendations, ensure_ascii=False))
+            )
+            return cursor.lastrowid
+
+    def get(self, review_id):
+        rows = self._select("WHERE id = ?", [review_id])
+        return rows[0] if rows else None
+
+    def set_mirror_job(self, review_id, job_id):
+        with connect_qa_db(self._path) as conn:
+            conn.execute("UPDATE reviews SET mirror_job = ? WHERE id = ?", (job_id, review_id))
+
+    def set_drive_links(self, review_id, drive_links):
+        with connect_qa_db(self._path) as conn:
+            conn.execute("UPDATE reviews SET drive_links = ? WHERE id = ?", (json.dumps(drive_links), review_id))
+
+    def query(self, since=None, until=None, limit=500, **filters):
+        """Revisiones más recientes primero; filtros exactos por brand/campaign/influencer/version
+        y rango de timestamp (texto "%Y-%m-%d %H:%M:%S", comparable como cadena)"""
+        conditions, params = [], []
+        for column in REVIEW_FILTERS:
+            if filters.get(column):
+                conditions.append(f"{column} = ?")
+                params.append(filters[column])
+        if since:
+            conditions.append("ts >= ?")
+            params.append(since)
+        if until:
+            conditions.append("ts <= ?")
+            params.append(until)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        return self._select(f"{where} ORDER BY ts DESC LIMIT ?", params + [limit])
+
+    def _select(self, clause, params):
+        with connect_qa_db(self._path) as conn:
+            rows = conn.execute(f"SELECT * FROM reviews {clause}", params).fetchall()
+        reviews = []
+        for row in rows:
+            review = dict(row)
+            for column in ("risks_json", "recommendations_json", "drive_links"):
+                review[column] = json.loads(review[column])
+            reviews.append(review)
+        return reviews
+
+    @staticmethod
+    def to_record(review):
+        """La revisión con las llaves que espera save_db_record"""
+        return {
+            "TS": review["ts"], "Brand": review["brand"], "Camp": review["campaign"],
+            "Inf": review["influencer"], "Ver": review["version"], "Score": review["score"],
+            "Recs": review["recs"],
+        }
+
+@process_singleton
+def get_review_store():
+    return ReviewStore(QA_DB_PATH)
+
+# OUTBOX (WRITE-BEHIND)
+# Drive y Sheets se escriben en segundo plano: el envío solo encola el trabajo en SQLite
+# y regresa. Un hilo lo drena con reintentos; si Google falla, el trabajo sigue en disco.
+OUTBOX_FILES_DIR = os.path.join(".qa_cache", "outbox_files")
+OUTBOX_FLUSH_INTERVAL = 2  # Segundos entre vueltas del flusher (y del sondeo de la UI)
+OUTBOX_BATCH_SIZE = 20
+OUTBOX_MAX_ATTEMPTS = 8
+OUTBOX_RETRY_BASE_DELAY = 5  # Segundos; se duplica en cada intento
+OUTBOX_RETRY_MAX_DELAY = 900
+# Archivos del spool que ningún trabajo pendiente usa se borran al arrancar; el margen evita
+# tocar uno recién escrito cuyo trabajo todavía no se encola
+OUTBOX_ORPHAN_FILE_AGE = 3600
+
+class Outbox:
+    """Cola persistente de escrituras a Google con dependencias entre trabajos.
+
+    Estados: queued -> running -> synced | failed. Un trabajo con `depends_on` espera a
+    que sus dependencias terminen y recibe sus resultados (también si fallaron: None).
+    Los handlers reciben (payload, resultados de dependencias, progress(hechos, total)).
+    on_failed(kind, payload) se llama cuando un trabajo falla definitivamente (p.ej. para
+    borrar los archivos que solo ese trabajo usaba).
+    """
+
+    def __init__(self, path, handlers, on_failed=None):
+        self._path = path
+        self._handlers = handlers
+        self._on_failed = on_failed
+        self._wakeup = threading.Event()
+        # Avance (0-1) de los trabajos en curso; solo en memoria, lo lee la UI
+        self._progress = {}
+        with connect_qa_db(self._path) as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS outbox (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    kind TEXT NOT NULL,
+                    payload TEXT NOT NULL,
+                    depends_on TEXT NOT NULL DEFAULT '[]',
+                    state TEXT NOT NULL DEFAULT 'queued',
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    next_attempt REAL NOT NULL DEFAULT 0,
+                    last_error TEXT,
+                    result TEXT,
+                    created REAL NOT NULL,
+                    updated REAL NOT NULL
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS outbox_state ON outbox (state, next_attempt)")
+            # Dependencias en una tabla aparte para filtrar en SQL los trabajos listos
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS outbox_deps (
+                    job_id INTEGER NOT NULL,
+                    depends_on INTEGER NOT NULL,
+                    PRIMARY KEY (job_id, depends_on)
+                )
+            """)
+            # Trabajos encolados antes de que existiera la tabla
+            for row in conn.execute("SELECT id, depends_on FROM outbox WHERE state = 'queued' AND depends_on != '[]'").fetchall():
+                conn.executemany(
+                    "INSERT OR IGNORE INTO outbox_deps (job_id, depends_on) VALUES (?, ?)",
+                    [(row["id"], dep_id) for dep_id in json.loads(row["depends_on"])]
+                )
+            # Trabajos que quedaron a medias si el proceso murió: se vuelven a encolar
+            conn.execute("UPDATE outbox SET state = 'queued' WHERE state = 'running'")
+        # Primera pasada inmediata: lo pendiente de antes del reinicio no espera al intervalo
+        self._wakeup.set()
+        threading.Thread(target=self._flush_loop, daemon=True, name="outbox-flusher").start()
+
+    def enqueue(self, kind, payload, depends_on=()):
+        """Guarda el trabajo y despierta al flusher; devuelve el id"""
+        now = time.time()
+        with connect_qa_db(self._path) as conn:
+            cursor = conn.execute(
+                "INSERT INTO outbox (kind, payload, depends_on, created, updated) VALUES (?, ?, ?, ?, ?)",
+                (kind, json.dumps(payload, ensure_ascii=False), json.dumps(list(depends_on)), now, now)
+            )
+            job_id = cursor.lastrowid
+            conn.executemany(
+                "INSERT OR IGNORE INTO outbox_deps (job_id, depends_on) VALUES (?, ?)",
+                [(job_id, dep_id) for dep_id in depends_on]
+            )
+        self._wakeup.set()
+        return job_id
+
+    def status(self, job_ids):
+        """{id: {state, attempts, last_error, result}} de los trabajos pedidos"""
+        if not job_ids:
+            return {}
+        placeholders = ",".join("?" * len(job_ids))
+        with connect_qa_db(self._path) as conn:
+            rows = conn.execute(
+                f"SELECT id, state, attempts, last_error, result FROM outbox WHERE id IN ({placeholders})",
+                list(job_ids)
+            ).fetchall()
+        return {
+            row["id"]: {
+                "state": row["state"],
+                "attempts": row["attempts"],
+                "last_error": row["last_error"],
+                "result": json.loads(row["result"]) if row["result"] else None,
+                "progress": self._progress.get(row["id"]),
+            }
+            for row in rows
+        }
+
+    def pending_payloads(self, kind):
+        """Payloads de los trabajos de `kind` que todavía pueden correr (queued/running)"""
+        with connect_qa_db(self._path) as conn:
+            rows = conn.execute(
+                "SELECT payload FROM outbox WHERE kind = ? AND state IN ('queued', 'running')", (kind,)
+            ).fetchall()
+        return [json.loads(row["payload"]) for row in rows]
+
+    def _claim_batch(self, limit):
+        """Marca como running hasta `limit` trabajos vencidos cuyas dependencias ya terminaron"""
+        if limit <= 0:
+            return []
+        with connect_qa_db(self._path) as conn:
+            # La condición de dependencias va antes del LIMIT: trabajos bloqueados (p.ej. en
+            # espera de una carpeta en backoff) no tapan a los que ya pueden correr
+            rows = conn.execute(
+                """
+                SELECT * FROM outbox
+                WHERE state = 'queued' AND next_attempt <= ?
+                  AND NOT EXISTS (
+                      SELECT 1 FROM outbox_deps d JOIN outbox p ON p.id = d.depends_on
+                      WHERE d.job_id = outbox.id AND p.state IN ('queued', 'running')
+                  )
+                ORDER BY id LIMIT ?
+                """,
+                (time.time(), min(limit, OUTBOX_BATCH_SIZE))
+            ).fetchall()
+            batch = []
+            for row in rows:
+                depends_on = json.loads(row["depends_on"])
+                dependencies = self.status(depends_on)
+                claimed = conn.execute(
+                    "UPDATE outbox SET state = 'running', updated = ? WHERE id = ? AND state = 'queued'",
+                    (time.time(), row["id"])
+                ).rowcount
+                if claimed:
+                    batch.append((row, [dependencies.get(dep_id, {}).get("result") for dep_id in depends_on]))
+        return batch
+
+    def _finish(self, job_id, state, result=None, error=None, attempts=None, next_attempt=0):
+        self._progress.pop(job_id, None)
+        with connect_qa_db(self._path) as conn:
+            conn.execute(
+                "UPDATE outbox SET state = ?, result = ?, last_error = ?, attempts = COALESCE(?, attempts), "
+                "next_attempt = ?, updated = ? WHERE id = ?",
+                (state, json.dumps(result, ensure_ascii=False) if result is not None else None,
+                 error, attempts, next_attempt, time.time(), job_id)
+            )
+
+    def _run(self, row, dependency_results):
+        try:
+            self._execute(row, dependency_results)
+        finally:
+            # Libera un lugar en el pool y puede desbloquear a los que dependen de este trabajo
+            self._wakeup.set()
+
+    def _execute(self, row, dependency_results):
+        attempts = row["attempts"] + 1
+        def progress(done, total):
+            self._progress[row["id"]] = done / total if total else 1.0
+        payload = json.loads(row["payload"])
+        try:
+            result = self._handlers[row["kind"]](payload, dependency_results, progress)
+        except Exception as e:
+            if attempts >= OUTBOX_MAX_ATTEMPTS:
+                print(f"❌ Outbox: {row['kind']} #{row['id']} falló definitivamente: {e}")
+                self._finish(row["id"], "failed", error=str(e), attempts=attempts)
+                if self._on_failed is not None:
+                    try:
+                        self._on_failed(row["kind"], payload)
+                    except Exception as cleanup_error:
+                        print(f"⚠️ Outbox: limpieza de {row['kind']} #{row['id']} falló: {cleanup_error}")
+            else:
+                delay = min(OUTBOX_RETRY_MAX_DELAY, OUTBOX_RETRY_BASE_DELAY * 2 ** (attempts - 1))
+                print(f"⏳ Outbox: {row['kind']} #{row['id']} falló ({e}); reintento {attempts}/{OUTBOX_MAX_ATTEMPTS} en {delay}s")
+                self._finish(row["id"], "queued", error=str(e), attempts=attempts, next_attempt=time.time() + delay)
+            return
+        self._finish(row["id"], "synced", result=result, attempts=attempts)
+
+    def _flush_loop(self):
+        # Grafo de tareas: un trabajo se reclama en cuanto sus dependencias terminan y hay un
+        # lugar libre en el pool, sin esperar a otros trabajos en curso. Así la carpeta se
+        # resuelve primero, archivo y reporte suben a la vez y Sheets espera solo sus links.
+        executor = ThreadPoolExecutor(max_workers=DRIVE_UPLOAD_WORKERS, thread_name_prefix="outbox")
+        in_flight = set()
+        while True:
+            self._wakeup.wait(OUTBOX_FLUSH_INTERVAL)
+            self._wakeup.clear()
+            in_flight = {future for future in in_flight if not future.done()}
+            try:
+                for row, dependency_results in self._claim_batch(DRIVE_UPLOAD_WORKERS - len(in_flight)):
+                    in_flight.add(executor.submit(self._run, row, dependency_results))
+            except Exception as e:
+                print(f"⚠️ Error en el flusher del outbox: {e}")
+
+def spool_outbox_file(name, data):
+    """Escribe el contenido (bytes o memoryview, sin copiarlo) a disco para que el trabajo
+    sobreviva reinicios"""
+    os.makedirs(OUTBOX_FILES_DIR, exist_ok=True)
+    path = os.path.join(OUTBOX_FILES_DIR, f"{uuid.uuid4().hex}_{os.path.basename(name)}")
+    with open(path, "wb") as f:
+        f.write(data)
+    return path
+
+def link_outbox_file(name, source_path):
+    """Fija el contenido actual de un archivo en disco para el trabajo: hard link al spool del
+    outbox (copia si el sistema de archivos no lo permite). Si el original se reemplaza
+    mientras el trabajo espera, el trabajo sigue subiendo los bytes que se encolaron."""
+    os.makedirs(OUTBOX_FILES_DIR, exist_ok=True)
+    path = os.path.join(OUTBOX_FILES_DIR, f"{uuid.uuid4().hex}_{os.path.basename(name)}")
+    try:
+        os.link(source_path, path)
+    except OSError:
+        shutil.copyfile(source_path, path)
+    return path
+
+def outbox_drive_target(payload, dependency_results=()):
+    """Servicio de Drive, carpeta raíz, ruta e id de la carpeta de versión del trabajo.
+
+    Usa la carpeta que resolvió el trabajo "drive_folder" del que depende; si ese trabajo
+    falló (o no hay), la resuelve aquí.
+    """
+    service = get_drive_service()
+    root_id = get_secret("GOOGLE_DRIVE_FOLDER_ID")
+    if not service or not root_id:
+        raise RuntimeError("Could not create the Google Drive service (check credentials.json / GOOGLE_DRIVE_FOLDER_ID)")
+    folder_path = [payload["campaign"], payload["influencer"], payload["version"]]
+    folder = next((result for result in dependency_results if result and "folder_id" in result), None)
+    ver_id = folder["folder_id"] if folder else resolve_folder_path(service, root_id, folder_path)
+    return service, root_id, folder_path, ver_id
+
+def sync_drive_folder(payload, _, _progress):
+    """Trabajo "drive_folder": resuelve (creando si hace falta) la carpeta de la versión una
+    sola vez, antes de las subidas que dependen de él"""
+    _, _, _, ver_id = outbox_drive_target(payload)
+    print(f"✅ Carpeta de versión creada/encontrada: {ver_id}")
+    folder_link = f"https://drive.google.com/drive/folders/{ver_id}"
+    return {"folder_id": ver_id, "folder": folder_link, "links": [folder_link]}
+
+def sync_drive_file(payload, dependency_results, progress):
+    """Trabajo "drive_file": sube un archivo a la carpeta de la versión.
+
+    La llave de reanudación es propia del trabajo: un reintento (o el mismo trabajo después
+    de un reinicio) continúa la subida en vez de reenviar el archivo completo.
+    """
+    service, root_id, folder_path, ver_id = outbox_drive_target(payload, dependency_results)
+    with open(payload["path"], "rb") as f:
+        uploaded, ver_id = upload_to_version_folder(
+            service, root_id, folder_path, ver_id, payload["name"], f, payload["mime_type"],
+            on_progress=progress, resume_key=payload["upload_id"]
+        )
+    if payload["owned"]:
+        os.remove(payload["path"])
+    print(f"  ✅ Archivo subido: {uploaded.get('webViewLink', '')}")
+    return {"folder": f"https://drive.google.com/drive/folders/{ver_id}", "links": [uploaded.get("webViewLink", "")]}
+
+def sync_drive_report(payload, dependency_results, _progress):
+    """Trabajo "drive_report": crea el Google Doc del reporte en la carpeta de la versión"""
+    service, root_id, folder_path, ver_id = outbox_drive_target(payload, dependency_results)
+    doc_file, ver_id = with_version_folder(
+        service, root_id, folder_path, ver_id,
+        lambda folder_id: create_google_doc(service, payload["title"], payload["report"], folder_id)
+    )
+    if not doc_file.get("webViewLink"):
+        raise RuntimeError("Could not create the Google Doc report")
+    print(f"✅ Google Doc creado: {doc_file['webViewLink']}")
+    return {"folder": f"https://drive.google.com/drive/folders/{ver_id}", "links": [doc_file["webViewLink"]]}
+
+def sync_review_mirror(payload, dependency_results, _progress):
+    """Trabajo "review_mirror": guarda en la revisión local los links que hayan producido sus
+    dependencias de Drive y, si Sheets está configurado, agrega la fila espejo.
+
+    Con payload["folder_job"] la primera dependencia es el trabajo "drive_folder": el link de
+    la carpeta sale de ahí aunque fallen el archivo y el reporte.
+    """
+    folder_result = None
+    if payload.get("folder_job"):
+        folder_result, dependency_results = dependency_results[0], dependency_results[1:]
+    synced = [result for result in [folder_result] + list(dependency_results) if result]
+    drive_links = [synced[0]["folder"] if synced else ""] if synced or dependency_results else []
+    for result in dependency_results:
+        # Un trabajo fallido deja su lugar vacío para no recorrer las columnas de Sheets
+        drive_links.extend(result["links"] if result else [""])
+    store = get_review_store()
+    store.set_drive_links(payload["review_id"], drive_links)
+    if payload["sheets"]:
+        review = store.get(payload["review_id"])
+        if not save_db_record(ReviewStore.to_record(review), drive_links):
+            raise RuntimeError("Could not save the record to Sheets")
+    return {"links": drive_links}
+
+def google_configured(secret_name):
+    """True si hay librerías, credentials.json y el secret del destino (carpeta u hoja)"""
+    return GOOGLE_SERVICES_AVAILABLE and os.path.exists("credentials.json") and bool(get_secret(secret_name))
+
+def release_outbox_file(kind, payload):
+    """on_failed del outbox: una subida que falló definitivamente ya no necesita su copia"""
+    if kind == "drive_file" and payload.get("owned"):
+        try:
+            os.remove(payload["path"])
+        except OSError:
+            pass
+
+def prune_outbox_files(outbox):
+    """Borra del spool los archivos que ningún trabajo pendiente usa (fallas definitivas de
+    antes de release_outbox_file, o archivos cuyo trabajo nunca se encoló)"""
+    try:
+        entries = list(os.scandir(OUTBOX_FILES_DIR))
+    except OSError:
+        return
+    in_use = {os.path.abspath(payload["path"]) for payload in outbox.pending_payloads("drive_file")}
+    for entry in entries:
+        try:
+            if os.path.abspath(entry.path) in in_use or time.time() - entry.stat().st_mtime < OUTBOX_ORPHAN_FILE_AGE:
+                continue
+            os.remove(entry.path)
+        except OSError:
+            pass
+
+@process_singleton
+def get_outbox():
+    outbox = Outbox(QA_DB_PATH, {
+        "drive_folder": sync_drive_folder,
+        "drive_file": sync_drive_file,
+        "drive_report": sync_drive_report,
+        "review_mirror": sync_review_mirror,
+    }, on_failed=release_outbox_file)
+    prune_outbox_files(outbox)
+    return outbox
+
+def queue_folder(campaign, influencer, version):
+    """Encola la resolución de la carpeta de la versión; devuelve el id (None sin Drive).
+
+    Las subidas y el reporte dependen de este trabajo para no crear la misma carpeta en
+    paralelo.
+    """
+    if not google_configured("GOOGLE_DRIVE_FOLDER_ID"):
+        return None
+    return get_outbox().enqueue("drive_folder", {"campaign": campaign, "influencer": influencer, "version": version})
+
+def queue_project_files(campaign, influencer, version, files, depends_on=()):
+    """Encola la subida a Drive de cada (nombre, origen, mime); devuelve los ids ([] sin Drive).
+
+    El origen puede ser la ruta de un archivo que ya está en disco (se enlaza al spool del
+    outbox con link_outbox_file, sin copiar) o su contenido en bytes/memoryview (se escribe
+    una vez al spool). En ambos casos el trabajo tiene su propio archivo inmutable, que se
+    borra al terminar la subida.
+    """
+    if not google_configured("GOOGLE_DRIVE_FOLDER_ID"):
+        return []
+    outbox = get_outbox()
+    job_ids = []
+    for name, source, mime_type in files:
+        path = link_outbox_file(name, source) if isinstance(source, str) else spool_outbox_file(name, source)
+        job_ids.append(outbox.enqueue("drive_file", {
+            "campaign": campaign, "influencer": influencer, "version": version,
+            "name": name, "mime_type": mime_type, "upload_id": uuid.uuid4().hex,
+            "path": path, "owned": True,
+        }, depends_on))
+    return job_ids
+
+def queue_report(title, report, depends_on=()):
+    """Encola la creación del Google Doc del reporte (ver render_report_docx); devuelve el id
+    (None sin Drive)"""
+    if not google_configured("GOOGLE_DRIVE_FOLDER_ID"):
+        return None
+    return get_outbox().enqueue("drive_report", {
+        "campaign": report["campaign"], "influencer": report["influencer"], "version": report["version"],
+        "title": title, "report": report,
+    }, depends_on)
+
+def queue_review_mirror(review_id, depends_on=(), folder_job=None):
+    """Encola el espejo de una revisión local (links de Drive + fila de Sheets); corre cuando
+    terminan los trabajos de Drive de los que depende (archivos y reporte, cuyos links van en
+    ese orden, y la carpeta de la versión). Devuelve el id (None si no hay nada que reflejar)."""
+    sheets = google_configured("GOOGLE_SHEET_ID")
+    if not sheets and not depends_on and not folder_job:
+        return None
+    payload = {"review_id": review_id, "sheets": sheets, "folder_job": bool(folder_job)}
+    job_ids = ([folder_job] if folder_job else []) + list(depends_on)
+    job_id = get_outbox().enqueue("review_mirror", payload, job_ids)
+    get_review_store().set_mirror_job(review_id, job_id)
+    return job_id
+
+# PROMPTS (English – AI will respond in English)
+PROMPT_F1 = """
+Act as an expert in advertising regulations (COFEPRIS) and alcohol for Heineken Mexico.
+Your task is to analyse the script looking ONLY for explicit breaches of the law or advertising regulations.
+
+CRITICAL RULES:
+1. Do NOT make assumptions or subjective inferences. Only point out what is EXPLICITLY written or described.
+2. Example: "Coffee shop" is just a café; do NOT assume drug references unless explicit.
+3. If there are no clear risks, state "No risks".
+4. Be brief, direct and corporate.
+5. Do NOT include invalid control characters in the JSON (tabs, literal newlines inside strings). Use \\n for line breaks.
+6. The email must end with "Best regards," followed by the name (the name will be added automatically; do NOT include it in email_draft).
+
+Return ONLY a valid JSON with this exact structure:
+{
+  "score": number (0-100),
+  "risks": [
+    {
+      "risk": "Short name of the risk",
+      "quote": "EXACT verbatim quote from the script where it occurs",
+      "explanation": "Legal explanation based on facts, not assumptions"
+    }
+  ],
+  "recommendations": [
+    "Concrete action 1",
+    "Concrete action 2"
+  ],
+  "email_draft": "Subject: Script Review - [Campaign]\\n\\nDear team,\\n\\nPlease find attached the findings...\\n\\nBest regards,"
+}
+"""
+
+PROMPT_F2 = """
+Act as Heineken Compliance Officer. Audit the video frame by frame under alcohol regulations (COFEPRIS).
+RULES:
+1. Only report visual or audio elements that appear in the video.
+2. Do NOT infer intentions.
+3. Focus on: actual alcohol consumption, minors, driving, excess.
+
+Return ONLY a valid JSON:
+{
+  "score": number (0-100),
+  "risks": [
+    {
+      "risk": "Visual Risk",
+      "timestamp": "MM:SS",
+      "explanation": "Observable fact that breaches the regulation"
+    }
+  ],
+  "recommendations": [
+    "Required edit 1"
+  ],
+  "email_draft": "Formal email body"
+}
+"""
+
+SCRIPT_ANALYSIS_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "score": {"type": "number"},
+        "risks": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "risk": {"type": "string"},
+                    "quote": {"type": "string"},
+                    "explanation": {"type": "string"}
+                },
+                "required": ["risk", "quote", "explanation"]
+            }
+        },
+        "recommendations": {"type": "array", "items": {"type": "string"}},
+        "email_draft": {"type": "string"}
+    },
+    "required": ["score", "risks", "recommendations", "email_draft"]
+}
+
+VIDEO_ANALYSIS_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "score": {"type": "number"},
+        "risks": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "risk": {"type": "string"},
+                    "timestamp": {"type": "string"},
+                    "explanation": {"type": "string"}
+                },
+                "required": ["risk", "timestamp", "explanation"]
+            }
+        },
+        "recommendations": {"type": "array", "items": {"type": "string"}},
+        "email_draft": {"type": "string"}
+    },
+    "required": ["score", "risks", "recommendations", "email_draft"]
+}
+
+PROMPT_SCHEMAS = {
+    PROMPT_F1: SCRIPT_ANALYSIS_SCHEMA,
+    PROMPT_F2: VIDEO_ANALYSIS_SCHEMA,
+}
+PROMPT_VALIDATORS = {prompt: compile_schema_validator(schema) for prompt, schema in PROMPT_SCHEMAS.items()}
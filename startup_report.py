@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+"""
+Reporte del costo de importación en el arranque en frío de app.py.
+
+Cada medición corre en un intérprete nuevo con `python -X importtime`, así que refleja
+lo que paga un contenedor recién escalado desde cero.
+
+Uso:
+    python startup_report.py            # arranque + dependencias diferidas
+    python startup_report.py --top 25   # más módulos en el desglose del arranque
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+
+# Lo que importa app.py en el primer render
+COLD_START_IMPORTS = ["streamlit", "qa_core"]
+
+# Dependencias que qa_core importa solo en el flujo que las necesita
+DEFERRED_IMPORTS = [
+    ("Script analysis / video audit (Gemini)", "google.generativeai"),
+    ("PDF parsing", "pypdf"),
+    ("DOCX parsing", "docx"),
+    ("Drive / Docs submission", "googleapiclient.discovery"),
+    ("Drive transport", "google_auth_httplib2"),
+    ("Sheets record", "gspread"),
+]
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def measure(preload, modules):
+    """Importa `preload` y luego `modules` en un intérprete nuevo.
+
+    Devuelve {paquete de primer nivel: µs} con solo lo que cargaron `modules`.
+    """
+    code = "".join(f"import {m}\n" for m in preload)
+    code += "import sys\nsys.stderr.write('--- measure ---\\n')\n"
+    code += "".join(f"import {m}\n" for m in modules)
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        cwd=REPO_DIR, capture_output=True, text=True
+    )
+    if proc.returncode != 0:
+        raise RuntimeError(proc.stderr.strip().splitlines()[-1])
+    _, _, measured = proc.stderr.partition("--- measure ---\n")
+
+    costs = {}
+    for line in measured.splitlines():
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        self_us, _, name = [part.strip() for part in line[len("import time:"):].split("|")]
+        top_level = name.split(".")[0]
+        costs[top_level] = costs.get(top_level, 0) + int(self_us)
+    return costs
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Heineken QA Compliance – startup import cost report")
+    parser.add_argument("--top", type=int, default=15, help="Packages to list in the cold-start breakdown")
+    args = parser.parse_args(argv)
+
+    cold = measure([], COLD_START_IMPORTS)
+    total = sum(cold.values())
+    print(f"🚀 Cold start imports ({', '.join(COLD_START_IMPORTS)}): {total / 1000:.0f} ms")
+    for name, us in sorted(cold.items(), key=lambda item: -item[1])[:args.top]:
+        print(f"   {us / 1000:8.1f} ms  {name}")
+
+    print("\n💤 Deferred until the code path needs them (each alone, on top of the cold start):")
+    available = []
+    for label, module in DEFERRED_IMPORTS:
+        try:
+            us = sum(measure(COLD_START_IMPORTS, [module]).values())
+        except RuntimeError as e:
+            print(f"   {'n/a':>8}     {module} ({label}): {e}")
+            continue
+        available.append(module)
+        print(f"   {us / 1000:8.1f} ms  {module} ({label})")
+    # Las dependencias compartidas (protobuf, google.auth, ...) se cuentan una sola vez
+    # midiendo todos los módulos diferidos juntos en el mismo intérprete
+    deferred_total = sum(measure(COLD_START_IMPORTS, available).values()) if available else 0
+    print(f"\n✅ Kept off the cold start (all deferred imports together): ~{deferred_total / 1000:.0f} ms")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())